@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+"""A local mirror of the AccurateRip database, and checking rips against it.
+
+The dBAR files AccurateRip serves are kept end to end in one data file that's memory mapped for
+reading, with a SQLite index of where each one is. Anything not in the mirror is fetched from
+the configured URL the first time it's asked for, and discs AccurateRip doesn't know are
+remembered for a while so they aren't asked about on every rip."""
+import argparse
+import fcntl
+import mmap
+import os
+import sqlite3
+import struct
+import threading
+import time
+import urllib.error
+import urllib.request
+import config
+
+
+CHUNK_HEADER = struct.Struct("<BIII")
+TRACK_ENTRY = struct.Struct("<BII")
+
+
+def dbar_name(ids):
+    """The name AccurateRip gives a disc's dBAR file, from discid.accuraterip_ids"""
+    return "dBAR-%03d-%08x-%08x-%08x.bin" % ids
+
+
+def dbar_path(ids):
+    """Where a disc's dBAR file lives on the AccurateRip server"""
+    id1 = ids[1]
+    return "%x/%x/%x/%s" % (id1 & 0xF, id1 >> 4 & 0xF, id1 >> 8 & 0xF, dbar_name(ids))
+
+
+def parse_dbar(data):
+    """Splits a dBAR file into its submissions: a list of lists of (confidence, checksum) for
+    each track"""
+    submissions = []
+    position = 0
+    while position + CHUNK_HEADER.size <= len(data):
+        track_count = CHUNK_HEADER.unpack_from(data, position)[0]
+        position += CHUNK_HEADER.size
+        tracks = []
+        for track in range(track_count):
+            if position + TRACK_ENTRY.size > len(data):
+                break
+            confidence, checksum, frame450 = TRACK_ENTRY.unpack_from(data, position)
+            tracks.append((confidence, checksum))
+            position += TRACK_ENTRY.size
+        submissions.append(tracks)
+    return submissions
+
+
+class Mirror(object):
+    """The dBAR files for every disc we've looked up or imported, in directory.
+
+    url is the base of the AccurateRip server (or anything laid out the same way) to fetch
+    from when a disc isn't mirrored; without one, the mirror is all there is. Discs the server
+    doesn't have are asked about again after ttl seconds."""
+
+    def __init__(self, directory, url=None, ttl=7 * 24 * 60 * 60, timeout=10):
+        self.directory = os.path.expanduser(directory)
+        os.makedirs(self.directory, exist_ok=True)
+        self.data_path = os.path.join(self.directory, "dbar.dat")
+        self.url = url
+        self.ttl = ttl
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.mapped = None
+        with self.connect() as db:
+            db.execute("CREATE TABLE IF NOT EXISTS dbar (name TEXT PRIMARY KEY, "
+                       "offset INTEGER, length INTEGER, fetched REAL)")
+
+    def connect(self):
+        return sqlite3.connect(os.path.join(self.directory, "dbar.sqlite"), timeout=30)
+
+    def add(self, files):
+        """Appends a list of (name, data) to the mirror. Empty data means the server doesn't
+        know the disc"""
+        now = time.time()
+        rows = []
+        with open(self.data_path, "ab") as f:
+            # other workers could be appending too
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                f.seek(0, os.SEEK_END)
+                for name, data in files:
+                    rows.append((name, f.tell(), len(data), now))
+                    f.write(data)
+                f.flush()
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+        with self.connect() as db:
+            db.executemany("INSERT OR REPLACE INTO dbar VALUES (?, ?, ?, ?)", rows)
+
+    def read(self, offset, length):
+        with self.lock:
+            if self.mapped is None or len(self.mapped) < offset + length:
+                # it's grown since it was mapped
+                if self.mapped is not None:
+                    self.mapped.close()
+                with open(self.data_path, "rb") as f:
+                    self.mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            return self.mapped[offset:offset + length]
+
+    def fetch(self, ids):
+        """Gets a disc's dBAR file from the server, or None if it couldn't be reached"""
+        try:
+            response = urllib.request.urlopen("%s/%s" % (self.url.rstrip("/"), dbar_path(ids)),
+                                              timeout=self.timeout)
+            with response:
+                data = response.read()
+        except urllib.error.HTTPError as err:
+            if err.code != 404:
+                return None
+            data = b""
+        except (urllib.error.URLError, OSError):
+            return None
+        self.add([(dbar_name(ids), data)])
+        return data
+
+    def lookup(self, ids):
+        """Returns the submissions for a disc, which are empty if nobody's submitted it (or the
+        server couldn't be reached)"""
+        with self.connect() as db:
+            row = db.execute("SELECT offset, length, fetched FROM dbar WHERE name = ?",
+                             (dbar_name(ids),)).fetchone()
+        if row is not None and (row[1] > 0 or row[2] > time.time() - self.ttl or
+                                not self.url):
+            return parse_dbar(self.read(row[0], row[1])) if row[1] > 0 else []
+        if not self.url:
+            return []
+        data = self.fetch(ids)
+        return parse_dbar(data) if data else []
+
+    def import_directory(self, path, batch=1000):
+        """Adds every dBAR-*.bin under path, like a copy of the server's tree. Returns how many
+        there were"""
+        count = 0
+        files = []
+        for directory, subdirectories, filenames in os.walk(path):
+            for filename in filenames:
+                if filename.startswith("dBAR-") and filename.endswith(".bin"):
+                    with open(os.path.join(directory, filename), "rb") as f:
+                        files.append((filename, f.read()))
+                if len(files) >= batch:
+                    self.add(files)
+                    count += len(files)
+                    files = []
+        self.add(files)
+        return count + len(files)
+
+
+def confidence(submissions, track_index, checksums_v1, checksum_v2, window_offset):
+    """Checks one track against a disc's submissions. checksums_v1 has the track's v1
+    checksum for every offset in the window, starting window_offset frames early, and
+    checksum_v2 is its v2 checksum with no offset.
+
+    Returns the offset that most submissions agree with and how many do (offset 0 means the
+    rip matches as is), along with how many submissions there are for the track altogether"""
+    offsets = {}
+    for index, checksum in enumerate(checksums_v1):
+        offsets.setdefault(checksum, []).append(index - window_offset)
+    matches = {}
+    total = 0
+    for tracks in submissions:
+        if track_index >= len(tracks):
+            continue
+        track_confidence, checksum = tracks[track_index]
+        total += track_confidence
+        matched = set(offsets.get(checksum, []))
+        if checksum == checksum_v2:
+            matched.add(0)
+        for offset in matched:
+            matches[offset] = matches.get(offset, 0) + track_confidence
+    if not matches:
+        return {'confidence': 0, 'offset': None, 'total': total}
+    # the rip's own alignment wins a tie
+    best = max(matches, key=lambda offset: (matches[offset], offset == 0))
+    return {'confidence': matches[best], 'offset': best, 'total': total}
+
+
+def make_mirror(app):
+    """Opens the mirror in ripper.accuraterip_mirror, fetching from ripper.accuraterip_url"""
+    return Mirror(config.option(app, 'ripper', 'accuraterip_mirror',
+                                '~/.cache/discripper/accuraterip'),
+                  config.option(app, 'ripper', 'accuraterip_url',
+                                'http://www.accuraterip.com/accuraterip'),
+                  config.option(app, 'ripper', 'accuraterip_ttl', 7 * 24 * 60 * 60, float))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Imports dBAR files into the local mirror")
+    parser.add_argument("path", help="a directory laid out like the AccurateRip server")
+    parser.add_argument("--mirror", help="the mirror directory, if not the configured one")
+    args = parser.parse_args()
+    if args.mirror is not None:
+        mirror = Mirror(args.mirror)
+    else:
+        from flask import Flask
+        app = Flask(__name__)
+        config.configure(app)
+        mirror = make_mirror(app)
+    print("imported %d discs" % mirror.import_directory(args.path))
+
+
+if __name__ == "__main__":
+    main()
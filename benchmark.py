@@ -0,0 +1,351 @@
+#!/usr/bin/env python3
+"""Measures how fast the ripper goes without a real drive or changer.
+
+SyntheticCDDAReader stands in for a drive and SimulatedMtx for the changer; either can also be
+used by the real workers by setting ripper.cdrom (or ripper.drives) or ripper.changer to
+"synthetic:" followed by a spec like the ones below. Running this file rips a magazine of
+synthetic discs through ripping.rip, one thread per drive, and prints how long each stage took
+and how many discs an hour that works out to. Progress still goes through redis, so it needs the
+same redis the workers use."""
+import argparse
+import os
+import random
+import tempfile
+import threading
+import time
+import uuid
+import audiotools
+from audiotools import pcm
+import sh
+from securerip import ERROR_COUNTERS
+from stages import StageTimer
+
+
+SECTOR_FRAMES = 588
+SECTORS_PER_SECOND = 75
+
+
+def parse_spec(spec, defaults):
+    """Parses "key=value,key=value" into a copy of defaults, converting each value to the type
+    of its default. Later keys win"""
+    options = dict(defaults)
+    for entry in spec.split(","):
+        if entry.strip() == "":
+            continue
+        key, _, value = entry.strip().partition("=")
+        if key not in defaults:
+            raise ValueError("Unknown option %s" % key)
+        options[key] = type(defaults[key])(value)
+    return options
+
+
+class SyntheticCDDAReader(object):
+    """Looks like a CDDAReader for a made up disc.
+
+    The spec sets how many tracks it has, roughly how long they are in seconds, how fast the
+    drive reads (in multiples of 1x, 0 for as fast as possible), how long a seek takes, how
+    likely each sector read is to show up as an error in the log, and the seed everything's
+    picked with. Track lengths vary by up to half either way, and the audio is noise, so the
+    encoders have about as much work to do as with real music."""
+
+    DEFAULTS = {'tracks': 12, 'length': 240.0, 'speed': 8.0, 'seek': 0.0, 'errors': 0.0,
+                'pregap': 0, 'seed': 1}
+
+    def __init__(self, spec=""):
+        self.options = parse_spec(spec, self.DEFAULTS)
+        self.sample_rate = 44100
+        self.channels = 2
+        self.channel_mask = 3
+        self.bits_per_sample = 16
+        self.random = random.Random(self.options['seed'])
+
+        self.track_offsets = {}
+        self.track_lengths = {}
+        offset = self.options['pregap'] * SECTOR_FRAMES
+        for track_number in range(1, self.options['tracks'] + 1):
+            seconds = self.options['length'] * self.random.uniform(0.5, 1.5)
+            length = max(4, int(seconds * SECTORS_PER_SECOND)) * SECTOR_FRAMES
+            self.track_offsets[track_number] = offset
+            self.track_lengths[track_number] = length
+            offset += length
+        self.total_frames = offset
+        self.first_sector = 150
+        self.last_sector = self.first_sector + self.total_frames // SECTOR_FRAMES - 1
+
+        # a second of noise, repeated for the whole disc
+        self.noise = bytes(self.random.getrandbits(8)
+                           for i in range(SECTORS_PER_SECOND * SECTOR_FRAMES * 4))
+        self.speed = self.options['speed']
+        self.position = 0
+        self.ready = time.time()
+        self.reset_log()
+
+    def set_speed(self, speed):
+        self.speed = float(speed)
+
+    def reset_log(self):
+        self.counters = {counter: 0 for counter in ERROR_COUNTERS}
+
+    def log(self):
+        return dict(self.counters)
+
+    def seek(self, pcm_frames):
+        """Seeks to the start of the sector pcm_frames is in, returning where that is"""
+        self.position = min(max(pcm_frames, 0), self.total_frames)
+        self.position -= self.position % SECTOR_FRAMES
+        time.sleep(self.options['seek'])
+        self.ready = time.time()
+        return self.position
+
+    def read(self, pcm_frames):
+        """Reads whole sectors, at least pcm_frames worth, at the drive's speed"""
+        sectors = -(-max(pcm_frames, 1) // SECTOR_FRAMES)
+        frames = min(sectors * SECTOR_FRAMES, self.total_frames - self.position)
+        if frames <= 0:
+            return pcm.empty_framelist(self.channels, self.bits_per_sample)
+
+        if self.speed > 0:
+            # the drive reads at a steady rate, however often it's asked
+            self.ready = max(self.ready, time.time() - 1) + (
+                frames / (self.speed * SECTORS_PER_SECOND * SECTOR_FRAMES))
+            delay = self.ready - time.time()
+            if delay > 0:
+                time.sleep(delay)
+        if self.options['errors'] > 0:
+            self.counters['readerr'] += sum(
+                1 for sector in range(frames // SECTOR_FRAMES)
+                if self.random.random() < self.options['errors'])
+
+        data = bytearray()
+        start = (self.position * 4) % len(self.noise)
+        while len(data) < frames * 4:
+            data += self.noise[start:start + frames * 4 - len(data)]
+            start = 0
+        self.position += frames
+        return pcm.FrameList(bytes(data), self.channels, self.bits_per_sample, False, True)
+
+    def close(self):
+        pass
+
+
+class SimulatedMtx(object):
+    """Takes the same arguments as sh.mtx and answers the way mtx would, for a changer with
+    slots storage elements (the first full of them loaded), an import/export slot after those,
+    and some number of drives.
+
+    Moves take move seconds and a status scan takes status seconds, one at a time since
+    there's only one arm. Anything mtx would refuse raises sh.ErrorReturnCode_1."""
+
+    DEFAULTS = {'slots': 40, 'full': 40, 'drives': 2, 'move': 6.0, 'status': 2.0}
+
+    def __init__(self, spec=""):
+        self.options = parse_spec(spec, self.DEFAULTS)
+        self.lock = threading.Lock()
+        self.ioslot = str(self.options['slots'] + 1)
+        self.slots = {str(slot): slot <= self.options['full']
+                      for slot in range(1, self.options['slots'] + 2)}
+        self.slots[self.ioslot] = False
+        # what's in each drive, and which slot it came from
+        self.drives = {drive: None for drive in range(self.options['drives'])}
+
+    def __call__(self, *args):
+        args = [str(arg) for arg in args]
+        command = args[3:]
+        with self.lock:
+            if command[0] == "status":
+                time.sleep(self.options['status'])
+                return self.status()
+            time.sleep(self.options['move'])
+            if command[0] == "eepos":
+                self.transfer(command[command.index("transfer") + 1],
+                              command[command.index("transfer") + 2], args)
+            elif command[0] == "load":
+                self.load(command[1], int(command[2]) if len(command) > 2 else 0, args)
+            elif command[0] == "unload":
+                if len(command) > 1:
+                    self.unload(command[1], int(command[2]) if len(command) > 2 else 0, args)
+                else:
+                    self.unload(self.drives[0], 0, args)
+            else:
+                self.fail(args)
+            return ""
+
+    def fail(self, args):
+        raise sh.ErrorReturnCode_1(" ".join(["mtx"] + args), b"", b"")
+
+    def transfer(self, source, destination, args):
+        if not self.slots.get(source) or self.slots.get(destination, True):
+            self.fail(args)
+        self.slots[source] = False
+        self.slots[destination] = True
+
+    def load(self, slot, drive, args):
+        if not self.slots.get(slot) or drive not in self.drives or self.drives[drive] is not None:
+            self.fail(args)
+        self.slots[slot] = False
+        self.drives[drive] = slot
+
+    def unload(self, slot, drive, args):
+        if self.drives.get(drive) is None or slot is None or self.slots.get(slot, True):
+            self.fail(args)
+        self.slots[slot] = True
+        self.drives[drive] = None
+
+    def status(self):
+        lines = ["  Storage Changer /dev/sg0:%d Drives, %d Slots ( 1 Import/Export )" % (
+            len(self.drives), len(self.slots))]
+        for drive, slot in sorted(self.drives.items()):
+            if slot is None:
+                lines.append("Data Transfer Element %d:Empty" % drive)
+            else:
+                lines.append("Data Transfer Element %d:Full (Storage Element %s Loaded)" % (
+                    drive, slot))
+        for slot in sorted(self.slots, key=int):
+            lines.append("      Storage Element %s%s:%s" % (
+                slot, " IMPORT/EXPORT" if slot == self.ioslot else "",
+                "Full " if self.slots[slot] else "Empty"))
+        return "\n".join(lines) + "\n"
+
+
+class BenchTask(object):
+    """Enough of a bound celery task for ripping.rip to report to"""
+
+    class Request(object):
+        def __init__(self):
+            self.id = "benchmark-%s" % uuid.uuid4()
+
+    def __init__(self):
+        self.request = self.Request()
+        self.state = None
+        self.meta = None
+
+    def update_state(self, task_id=None, state=None, meta=None):
+        self.state = state
+        self.meta = meta
+
+
+def seed_metadata(metadata_cache, cddareader, disc_key, number):
+    """Caches made up metadata for a synthetic disc, so ripping it doesn't go to the network"""
+    total = len(cddareader.track_offsets)
+    metadata_cache.put(disc_key, [[audiotools.MetaData(track_name="Track %d" % track_number,
+                                                       track_number=track_number,
+                                                       track_total=total,
+                                                       album_name="Synthetic Disc %d" % number,
+                                                       artist_name="Benchmark")
+                                   for track_number in sorted(cddareader.track_offsets)]])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--discs", type=int, default=4, help="how many discs to rip")
+    parser.add_argument("--drives", type=int, default=1, help="how many drives to rip them on")
+    parser.add_argument("--disc", default="", help="SyntheticCDDAReader spec for every disc")
+    parser.add_argument("--changer", default="move=6,status=2",
+                        help="SimulatedMtx spec (slots, full and drives come from the above)")
+    parser.add_argument("--formats", help="overrides ripper.formats")
+    parser.add_argument("--output", help="where to write the tracks (a scratch directory)")
+    parser.add_argument("--lookup", action="store_true",
+                        help="look metadata up for real instead of making it up")
+    args = parser.parse_args()
+
+    # imported here so the classes above can be used without a full config
+    import fakemtx as mtx
+    import discid
+    from metacache import MetadataCache
+    from metrics import Metrics
+    from scheduler import Scheduler
+    import tasks
+    import ripping
+
+    scratch = args.output or tempfile.mkdtemp(prefix="ripper-benchmark-")
+    ripper = tasks.app.config.setdefault('ripper', {})
+    ripper['output_directory'] = os.path.join(scratch, "output")
+    ripper['journal_directory'] = os.path.join(scratch, "journal")
+    # nobody has submitted made up discs, so there's no sense asking AccurateRip about them
+    ripper['accuraterip_mirror'] = os.path.join(scratch, "accuraterip")
+    ripper['accuraterip_url'] = ""
+    # nor should they end up in the real rip log, or be reused by real rips
+    ripper['rip_log'] = os.path.join(scratch, "riplog.sqlite")
+    ripper['dedup_index'] = os.path.join(scratch, "dedup.sqlite")
+    if args.formats is not None:
+        ripper['formats'] = args.formats
+    # a cache and metrics of its own, so nothing made up ends up in the real ones
+    tasks.metadata_cache = MetadataCache(os.path.join(scratch, "metadata.sqlite"),
+                                         30 * 24 * 60 * 60, 10000)
+    tasks.metrics = Metrics(tasks.redis, "ripper:benchmark:metrics")
+    # the synthetic slots mustn't overwrite what's known about the real magazine's
+    tasks.scheduler = Scheduler(tasks.redis, tasks.drives, "ripper:benchmark:schedule")
+
+    discs = {}
+    for number in range(1, args.discs + 1):
+        spec = "%s,seed=%d" % (args.disc,
+                               SyntheticCDDAReader.DEFAULTS['seed'] + number)
+        discs[str(number)] = spec
+        if not args.lookup:
+            cddareader = SyntheticCDDAReader(spec)
+            seed_metadata(tasks.metadata_cache, cddareader, discid.toc_key(cddareader), number)
+
+    simulated = SimulatedMtx("%s,slots=%d,full=%d,drives=%d" % (
+        args.changer, max(args.discs, 1), args.discs, args.drives))
+    changer = mtx.Changer("synthetic", mtx=simulated)
+    timer = StageTimer()
+    with timer.time('changer'):
+        changer.update_status()
+
+    pending = sorted(discs, key=int)
+    pending_lock = threading.Lock()
+    results = []
+    failures = []
+
+    def drive_worker(drive):
+        while True:
+            with pending_lock:
+                if not pending:
+                    return
+                slot = pending.pop(0)
+            task = BenchTask()
+            try:
+                with timer.time('changer'):
+                    changer.load_drive(slot, drive)
+                try:
+                    result = ripping.rip(task, "synthetic:%s" % discs[slot], slot)
+                finally:
+                    with timer.time('changer'):
+                        changer.unload_drive(slot, drive)
+            except Exception as err:
+                # rip() puts the reason in the task's state before giving up
+                failures.append((slot, task.meta if task.state == 'FAILURE' else err))
+                continue
+            for stage, totals in result['stages'].items():
+                timer.add(stage, totals['seconds'], totals['frames'], totals['calls'])
+            results.append(result)
+
+    started = time.time()
+    workers = [threading.Thread(target=drive_worker, args=(drive,))
+               for drive in range(args.drives)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.time() - started
+
+    print("%-12s %10s %8s %12s %10s" % ("stage", "seconds", "calls", "frames", "x realtime"))
+    for stage, totals in sorted(timer.report().items()):
+        print("%-12s %10.2f %8d %12d %10s" % (
+            stage, totals['seconds'], totals['calls'], totals['frames'],
+            "" if not totals['frames'] or totals['rate'] is None else
+            "%.1f" % (totals['rate'] / 44100)))
+    frames = sum(result['frames'] for result in results)
+    print()
+    print("%d discs ripped, %d failed, in %.1f seconds" % (len(results), len(failures), elapsed))
+    for slot, err in failures:
+        print("  disc %s: %s" % (slot, err))
+    if elapsed > 0:
+        print("%.1f discs/hour, %.2f MB/s, %.1fx realtime" % (
+            len(results) * 3600 / elapsed, frames * 4 / 1000000 / elapsed,
+            frames / 44100 / elapsed))
+    print("output in %s" % scratch)
+
+
+if __name__ == "__main__":
+    main()
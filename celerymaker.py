@@ -1,5 +1,22 @@
 """Integrates celery and flask"""
 from celery import Celery
+from celery.signals import task_postrun
+import json
+from redismaker import make_redis
+
+
+# the queue each task goes on, whether it's sent by the workers or by name from the webapp
+ROUTES = {
+    'tasks.rip_disk': {'queue': 'cdrom'},
+    'tasks.mtx_command': {'queue': 'changer'},
+    'tasks.prewarm_metadata': {'queue': 'cdrom'},
+    'tasks.batch_rip': {'queue': 'batch'}
+    }
+
+
+def task_channel(task_id):
+    """The redis pub/sub channel updates about a task are published on"""
+    return "ripper:task:%s" % task_id
 
 
 def make_celery(app):
@@ -8,7 +25,14 @@ def make_celery(app):
                     broker=app.config['CELERY_BROKER_URL'],
                     backend=app.config['CELERY_RESULT_BACKEND'])
     celery.conf.update(app.config)
+    celery.conf.update(CELERY_ROUTES=ROUTES)
     TaskBase = celery.Task
+    redis = make_redis(app)
+
+    def publish(task_id, state, meta):
+        """Pushes a task update to whoever's listening, as well as storing it in the backend"""
+        message = {'task_id': task_id, 'state': state, 'info': meta}
+        redis.publish(task_channel(task_id), json.dumps(message, default=str))
 
     class ContextTask(TaskBase):
         abstract = True
@@ -17,5 +41,15 @@ def make_celery(app):
             with app.app_context():
                 return TaskBase.__call__(self, *args, **kwargs)
 
+        def update_state(self, task_id=None, state=None, meta=None):
+            TaskBase.update_state(self, task_id, state, meta)
+            publish(task_id or self.request.id, state, meta)
+
+    @task_postrun.connect(weak=False)
+    def publish_result(task_id=None, retval=None, state=None, **kwargs):
+        # ignored tasks already published the state they stored themselves
+        if state in ('SUCCESS', 'FAILURE', 'RETRY'):
+            publish(task_id, state, retval)
+
     celery.Task = ContextTask
     return celery
@@ -0,0 +1,103 @@
+"""AccurateRip checksums and silence detection done with numpy instead of sample by sample"""
+import numpy
+
+
+# AccurateRip skips the first and last five sectors of the disc
+SKIPPED_FRAMES = 588 * 5
+
+
+def frames_to_array(framelist, dtype):
+    """Views a 16 bit stereo FrameList as a numpy array.
+
+    FrameLists don't expose the buffer protocol, so this costs the one copy to_bytes makes;
+    the array itself is a view over those bytes. With dtype '<u4' each element is one whole
+    stereo frame, packed the way AccurateRip wants it."""
+    return numpy.frombuffer(framelist.to_bytes(False, True), dtype=dtype)
+
+
+def is_silent(framelist):
+    """Checks whether every sample in framelist is zero"""
+    return not frames_to_array(framelist, '<i2').any()
+
+
+class Checksum(object):
+    """A drop-in replacement for audiotools.accuraterip.Checksum.
+
+    Rather than summing every offset in the window separately, it keeps running sums of x[i]
+    and (i + 1) * x[i] over the stream and remembers them at the edges of each offset's range,
+    since for the track starting k frames into the window
+
+        sum (i - k + 1) * x[i] == sum (i + 1) * x[i] - k * sum x[i]
+
+    All of the arithmetic wraps around at 32 bits, the same as AccurateRip's."""
+
+    def __init__(self, total_pcm_frames, sample_rate=44100, is_first=False, is_last=False,
+                 pcm_frame_range=1, accurateripv2_offset=0):
+        self.total_pcm_frames = total_pcm_frames
+        self.pcm_frame_range = pcm_frame_range
+        self.accurateripv2_offset = accurateripv2_offset
+
+        # the part of the track that's checksummed, relative to where it starts
+        self.start = SKIPPED_FRAMES - 1 if is_first else 0
+        self.end = total_pcm_frames - SKIPPED_FRAMES if is_last else total_pcm_frames
+
+        # running sums of x[i] and (i + 1) * x[i] at each of the positions the offsets need
+        self.sums_at_start = numpy.zeros((2, pcm_frame_range), dtype=numpy.uint32)
+        self.sums_at_end = numpy.zeros((2, pcm_frame_range), dtype=numpy.uint32)
+        self.sum = numpy.uint32(0)
+        self.weighted_sum = numpy.uint32(0)
+        self.v2 = 0
+        self.position = 0
+
+    def update(self, framelist):
+        values = frames_to_array(framelist, '<u4')
+        if len(values) == 0:
+            return
+        first = self.position
+        self.position += len(values)
+        positions = numpy.arange(first, self.position, dtype=numpy.uint64)
+
+        with numpy.errstate(over='ignore'):
+            # prefix sums, where prefix[t - first] covers every frame before t
+            sums = numpy.empty(len(values) + 1, dtype=numpy.uint32)
+            sums[0] = self.sum
+            numpy.cumsum(values, dtype=numpy.uint32, out=sums[1:])
+            sums[1:] += self.sum
+            weighted = numpy.empty(len(values) + 1, dtype=numpy.uint32)
+            weighted[0] = self.weighted_sum
+            numpy.cumsum((positions + 1).astype(numpy.uint32) * values, dtype=numpy.uint32,
+                         out=weighted[1:])
+            weighted[1:] += self.weighted_sum
+        self.sum = sums[-1]
+        self.weighted_sum = weighted[-1]
+
+        for edge, saved in [(self.start, self.sums_at_start), (self.end, self.sums_at_end)]:
+            low = max(edge, first)
+            high = min(edge + self.pcm_frame_range - 1, self.position)
+            if low <= high:
+                saved[0, low - edge:high - edge + 1] = sums[low - first:high - first + 1]
+                saved[1, low - edge:high - edge + 1] = weighted[low - first:high - first + 1]
+
+        # v2 needs the high halves of the 64 bit products, so it's only done at one offset
+        offset = self.accurateripv2_offset
+        low = max(offset + self.start, first)
+        high = min(offset + self.end, self.position)
+        if low < high:
+            multipliers = positions[low - first:high - first] - offset + 1
+            products = multipliers * values[low - first:high - first].astype(numpy.uint64)
+            self.v2 = (self.v2 +
+                       int((products & 0xFFFFFFFF).sum(dtype=numpy.uint64)) +
+                       int((products >> 32).sum(dtype=numpy.uint64))) & 0xFFFFFFFF
+
+    def checksums_v1(self):
+        """Returns the AccurateRip v1 checksum for every offset in the window"""
+        offsets = numpy.arange(self.pcm_frame_range, dtype=numpy.uint32)
+        with numpy.errstate(over='ignore'):
+            sums = self.sums_at_end[0] - self.sums_at_start[0]
+            weighted = self.sums_at_end[1] - self.sums_at_start[1]
+            checksums = weighted - offsets * sums
+        return [int(checksum) for checksum in checksums]
+
+    def checksum_v2(self):
+        """Returns the AccurateRip v2 checksum at accurateripv2_offset"""
+        return self.v2
@@ -15,3 +15,18 @@ def configure(app):
             app.config[section] = {}
             for key in config[section]:
                 app.config[section][key] = config[section][key]
+
+
+def option(app, section, key, default=None, kind=str):
+    """Looks up a single setting, converting it with kind, or returns default if it's not set"""
+    if section not in app.config or key not in app.config[section]:
+        return default
+    return kind(app.config[section][key])
+
+
+def flag(app, section, key, default=False):
+    """Looks up a yes/no setting"""
+    value = option(app, section, key)
+    if value is None:
+        return default
+    return value.strip().lower() in ('1', 'yes', 'true', 'on')
@@ -0,0 +1,146 @@
+"""Remembers every track that's been ripped, so discs we've already got aren't ripped again"""
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import time
+import audiotools
+import config
+
+
+SECTOR_FRAMES = 588
+
+
+def probe_range(track_length, probe_frames):
+    """Returns the (start, length) within a track that gets read to recognise it: a sector
+    aligned stretch from the middle, well clear of any offset trouble at either end"""
+    start = track_length // 2
+    start -= start % SECTOR_FRAMES
+    return start, min(probe_frames, track_length - start)
+
+
+def digest(pcmreader):
+    """Hashes everything pcmreader has to give"""
+    probe = hashlib.sha1()
+    audiotools.transfer_data(pcmreader.read,
+                             lambda framelist: probe.update(framelist.to_bytes(False, True)))
+    return probe.hexdigest()
+
+
+class ProbeDigest(object):
+    """Hashes the same stretch digest() would have read from a track as the track's ripped, so
+    it can go in the index without being read twice. It's fed like a QueueReader"""
+
+    def __init__(self, start, length):
+        self.start = start
+        self.end = start + length
+        self.position = 0
+        self.probe = hashlib.sha1()
+
+    def put(self, framelist):
+        first = max(self.start - self.position, 0)
+        last = min(self.end - self.position, framelist.frames)
+        if first < last:
+            self.probe.update(framelist.split(last)[0].split(first)[1].to_bytes(False, True))
+        self.position += framelist.frames
+
+    def finish(self):
+        pass
+
+    def hexdigest(self):
+        return self.probe.hexdigest()
+
+
+def link(source, destination):
+    """Puts the file at source at destination too, hard linked if they're on the same
+    filesystem. Only for files that are the very same track, tags and all, since anything
+    written to one is written to both"""
+    if os.path.exists(destination):
+        if os.path.samefile(source, destination):
+            return
+        os.remove(destination)
+    audiotools.make_dirs(destination)
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copy2(source, destination)
+
+
+def copy(source, destination):
+    """Puts a copy of the file at source at destination, to be tagged as something else"""
+    if os.path.exists(destination):
+        if os.path.samefile(source, destination):
+            return
+        os.remove(destination)
+    audiotools.make_dirs(destination)
+    shutil.copy2(source, destination)
+
+
+class DedupIndex(object):
+    """A SQLite index of ripped tracks, keyed by disc and by a hash of a probe read from the
+    middle of each track, with the files they were encoded to and their logs.
+
+    formats is a list like ["flac:8", "mp3:2"] and files are in the same order; a track can
+    only be reused for a rip that wants the very same formats."""
+
+    def __init__(self, path):
+        self.path = os.path.expanduser(path)
+        if os.path.dirname(self.path) != "":
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with self.connect() as db:
+            db.execute("CREATE TABLE IF NOT EXISTS tracks (disc TEXT, track_number INTEGER, "
+                       "length INTEGER, probe TEXT, formats TEXT, files TEXT, log TEXT, "
+                       "ripped REAL, PRIMARY KEY (disc, track_number, formats))")
+            db.execute("CREATE INDEX IF NOT EXISTS tracks_probe ON tracks (length, probe)")
+
+    def connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def add(self, disc, track_number, length, probe, formats, files, log,
+            accuraterip_v1, accuraterip_v2):
+        track = {'log': log, 'accuraterip_v1': accuraterip_v1, 'accuraterip_v2': accuraterip_v2}
+        with self.connect() as db:
+            db.execute("INSERT OR REPLACE INTO tracks VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                       (disc, track_number, length, probe, json.dumps(formats),
+                        json.dumps([os.path.abspath(f) for f in files]), json.dumps(track),
+                        time.time()))
+
+    def candidates(self, length, formats):
+        """Whether anything of this length has been ripped to formats, which is the only time
+        a track's worth probing"""
+        with self.connect() as db:
+            return db.execute("SELECT 1 FROM tracks WHERE length = ? AND formats = ? LIMIT 1",
+                              (length, json.dumps(formats))).fetchone() is not None
+
+    def find(self, disc, track_number, length, probe, formats):
+        """Returns what was recorded about the best match for a track, or None. The same track
+        of the same disc is preferred, but the same audio anywhere else will do, and 'disc' and
+        'track_number' say which it was. Matches whose files have gone missing are skipped"""
+        with self.connect() as db:
+            rows = db.execute("SELECT disc, track_number, files, log FROM tracks "
+                              "WHERE length = ? AND probe = ? AND formats = ? "
+                              "ORDER BY (disc = ? AND track_number = ?) DESC, ripped DESC",
+                              (length, probe, json.dumps(formats), disc,
+                               track_number)).fetchall()
+        for match_disc, match_track_number, files, log in rows:
+            files = json.loads(files)
+            if all(self.intact(filename, length) for filename in files):
+                track = json.loads(log)
+                track['disc'] = match_disc
+                track['track_number'] = match_track_number
+                track['files'] = files
+                return track
+        return None
+
+    def intact(self, filename, length):
+        try:
+            return audiotools.open(filename).total_frames() == length
+        except (IOError, audiotools.UnsupportedFile, audiotools.InvalidFile):
+            return False
+
+
+def make_dedup_index(app):
+    """Opens the index in ripper.dedup_index"""
+    return DedupIndex(config.option(app, 'ripper', 'dedup_index',
+                                    '~/.cache/discripper/dedup.sqlite'))
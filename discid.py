@@ -0,0 +1,40 @@
+"""Identifies discs by their table of contents"""
+import hashlib
+
+
+def toc_key(cddareader):
+    """Returns a key that's the same for every disc pressed with the same TOC"""
+    toc = ",".join("%d:%d:%d" % (track_number,
+                                 cddareader.track_offsets[track_number],
+                                 cddareader.track_lengths[track_number])
+                   for track_number in sorted(cddareader.track_offsets))
+    return hashlib.sha1(toc.encode('ascii')).hexdigest()
+
+
+def accuraterip_ids(cddareader):
+    """Returns the (track count, id1, id2, freedb id) AccurateRip knows the disc in cddareader by.
+
+    They're worked out from where each track starts, in sectors, and where the lead-out is,
+    ignoring any hidden track before track 1"""
+    track_numbers = [track_number for track_number in sorted(cddareader.track_offsets)
+                     if track_number > 0]
+    offsets = [cddareader.track_offsets[track_number] // 588 for track_number in track_numbers]
+    last = track_numbers[-1]
+    lead_out = (cddareader.track_offsets[last] + cddareader.track_lengths[last]) // 588
+
+    id1 = (sum(offsets) + lead_out) & 0xFFFFFFFF
+    id2 = (sum(max(offset, 1) * track_number
+               for track_number, offset in enumerate(offsets, 1)) +
+           lead_out * (len(offsets) + 1)) & 0xFFFFFFFF
+
+    # freedb counts in seconds from the very start of the disc, two seconds before track 1
+    digits = sum(sum(int(digit) for digit in str((offset + 150) // 75)) for offset in offsets)
+    length = (lead_out + 150) // 75 - (offsets[0] + 150) // 75
+    freedb = ((digits % 255) << 24 | length << 8 | len(offsets)) & 0xFFFFFFFF
+    return (len(offsets), id1, id2, freedb)
+
+
+def total_frames(cddareader):
+    """Returns how many PCM frames there are to rip on the disc in cddareader"""
+    return sum(cddareader.track_lengths[track_number]
+               for track_number in cddareader.track_offsets if track_number > 0)
@@ -0,0 +1,97 @@
+"""Schedules rips across all of the changer's drives"""
+import threading
+import config
+
+
+class DrivePool(object):
+    """Tracks which drives are busy and how many jobs are waiting on each.
+
+    The state lives in redis, so every web process and worker sees the same pool."""
+
+    def __init__(self, redis, devices, lease=7200):
+        self.redis = redis
+        self.devices = devices
+        self.lease = lease
+
+    def busy_key(self, drive):
+        return "ripper:drive:%d:busy" % drive
+
+    def queued_key(self, drive):
+        return "ripper:drive:%d:queued" % drive
+
+    def device(self, drive):
+        return self.devices[drive]
+
+    def enqueue(self, drive):
+        """Counts a new job against a drive's queue"""
+        self.redis.incr(self.queued_key(drive))
+
+    def dequeue(self, drive):
+        """Stops counting a job against a drive's queue once it starts running"""
+        if self.redis.decr(self.queued_key(drive)) < 0:
+            self.redis.set(self.queued_key(drive), 0)
+
+    def claim(self, owner, preferred=None, any_drive=True):
+        """Claims a free drive for owner, trying preferred first, and only preferred unless
+        any_drive is set. Returns None if they're all busy"""
+        drives = list(range(len(self.devices)))
+        if preferred is not None:
+            drives.remove(preferred)
+            drives.insert(0, preferred)
+            if not any_drive:
+                drives = [preferred]
+        for drive in drives:
+            if self.redis.set(self.busy_key(drive), owner, nx=True, ex=self.lease):
+                return drive
+        return None
+
+    def renew(self, drive, owner):
+        """Extends owner's lease on a drive, provided owner is still the one holding it"""
+        if self.redis.get(self.busy_key(drive)) == owner:
+            self.redis.expire(self.busy_key(drive), self.lease)
+
+    def hold(self, drive, owner):
+        """Keeps renewing owner's lease on a drive from a thread of its own, since a rip of a
+        bad disc can outlast it, until the returned event is set. If the worker dies, so does
+        the thread, and the lease runs out as before"""
+        stop = threading.Event()
+
+        def heartbeat():
+            while not stop.wait(self.lease / 4):
+                self.renew(drive, owner)
+        threading.Thread(target=heartbeat, daemon=True).start()
+        return stop
+
+    def release(self, drive, owner):
+        """Frees a drive, provided owner is still the one holding it"""
+        if self.redis.get(self.busy_key(drive)) == owner:
+            self.redis.delete(self.busy_key(drive))
+
+    def changer_lock(self):
+        """The changer only has one arm, so every move has to hold this"""
+        return self.redis.lock("ripper:changer", timeout=600)
+
+    def load(self, changer, slot, drive):
+        with self.changer_lock():
+            changer.load_drive(slot, drive)
+
+    def unload(self, changer, slot, drive):
+        with self.changer_lock():
+            changer.unload_drive(slot, drive)
+
+    def status(self):
+        """Returns what each drive is doing and how many jobs are waiting for it"""
+        status = []
+        for drive, device in enumerate(self.devices):
+            status.append({'drive': drive,
+                           'device': device,
+                           'busy': self.redis.get(self.busy_key(drive)),
+                           'queued': int(self.redis.get(self.queued_key(drive)) or 0)})
+        return status
+
+
+def make_drive_pool(app, redis):
+    """Builds the drive pool from the ripper.drives list, or the single ripper.cdrom drive"""
+    devices = config.option(app, 'ripper', 'drives', app.config['ripper'].get('cdrom'))
+    devices = [device.strip() for device in devices.split(",") if device.strip() != ""]
+    return DrivePool(redis, devices, config.option(app, 'ripper', 'drive_lease', 7200, int))
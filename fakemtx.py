@@ -2,6 +2,7 @@
 """Pretends to be mtx.py, but just executes shell commands and parses the output"""
 import sh
 import re
+from metrics import TimedMtx
 # import json
 import logging
 
@@ -13,15 +14,38 @@ class Changer(object):
     Represents a media changer device, and uses pyscsi to control it
     """
 
-    def __init__(self, changer, do_status_update=False):
+    def __init__(self, changer, do_status_update=False, inventory=None, mtx=None, metrics=None):
         self.status = {}
         self.ioslot = None
         self.changer = changer
+        self.inventory = inventory
+        # anything that takes mtx's arguments and returns its output, like benchmark.SimulatedMtx
+        self.mtx = sh.mtx if mtx is None else mtx
+        if metrics is not None:
+            self.mtx = TimedMtx(self.mtx, metrics)
         if do_status_update:
             self.update_status()
+        else:
+            self.refresh()
+
+    def refresh(self):
+        """
+        Picks up any moves other processes made from the shared inventory, if there is one
+        """
+        if self.inventory is not None:
+            status, ioslot = self.inventory.load()
+            if status:
+                self.status = status
+                self.ioslot = ioslot
+        return self.status
+
+    def save_slot(self, slot):
+        """Records a slot's new state in the shared inventory, if there is one"""
+        if self.inventory is not None:
+            self.inventory.save_slot(slot, self.status[slot])
 
     def update_status(self):
-        rawstatus = sh.mtx('-f', self.changer, "altres", "status").split("\n")
+        rawstatus = self.mtx('-f', self.changer, "altres", "status").split("\n")
         mtxregexstring = "Storage Element (?P<number>[0-9]*)(?P<io> IMPORT/EXPORT|):"
         mtxregexstring += "(?P<state>Empty|Full).*"
         mtxregex = re.compile(mtxregexstring)
@@ -41,30 +65,45 @@ class Changer(object):
 
                 # If we previously believed this to be in a different state than it is, then our
                 # information about what's in there is probably wrong
-                elif 'state' in self.status[status['number']]:
-                    if status['state'] != self.status[status['number']]['state']:
-                        self.status[status['number']] = {}
-                        self.status[status['number']]['full'] = status['state'] == "Full"
+                elif (status['state'] == "Full") != self.status[status['number']]['full']:
+                    self.status[status['number']] = {}
+                    self.status[status['number']]['full'] = status['state'] == "Full"
+        if self.inventory is not None:
+            self.inventory.save(self.status, self.ioslot)
         return self.status
 
+    def transfer(self, source, destination):
+        """
+        Moves a disk from one storage element to another, keeping track of both of them
+        """
+        self.mtx('-f', self.changer, 'altres', 'eepos', '0', 'transfer', source, destination)
+        for slot, full in [(source, False), (destination, True)]:
+            if slot in self.status:
+                self.status[slot]['full'] = full
+                self.save_slot(slot)
+
     def load(self, slot=None):
         """
         Causes the changer to accept a disk and load it into the specified slot. If no slot is
         specified, it selects an empty slot (update_status() must have been run already). Returns
         the slot the disk was inserted into
         """
+        self.refresh()
         if self.ioslot is None:
             raise NeverScannedError()
         if slot is None:
+            # the closest empty slot to the import/export slot is the shortest trip for the arm
             for possible in self.status:
-                if self.status[possible]['full'] is False:
-                    slot = possible
+                # a slot whose disc is out in a drive only looks empty
+                if self.status[possible]['full'] is False and 'drive' not in self.status[possible]:
+                    if slot is None or (abs(int(possible) - int(self.ioslot)) <
+                                        abs(int(slot) - int(self.ioslot))):
+                        slot = possible
             if slot is None:
                 # No slots available to load stuff into
                 raise NoSlotsAvailableError()
         try:
-            sh.mtx('-f', self.changer, 'altres', 'eepos', '0', 'transfer', self.ioslot, slot)
-            self.status[slot]['full'] = True
+            self.transfer(self.ioslot, slot)
             return slot
         except sh.ErrorReturnCode_1:
             return False
@@ -74,10 +113,10 @@ class Changer(object):
         Causes the changer to unload the disk from the specified slot and eject it from the changer
         """
         ejected = False
+        self.refresh()
         try:
-            sh.mtx('-f', self.changer, 'altres', 'eepos', '0', 'transfer', slot, self.ioslot)
+            self.transfer(slot, self.ioslot)
             ejected = True
-            self.status[slot]['full'] = False
         except sh.ErrorReturnCode_1:
             pass
         return ejected
@@ -87,9 +126,13 @@ class Changer(object):
         Loads the disk from the specified slot into the specified drive (default drive is 0)
         """
         try:
-            sh.mtx('-f', self.changer, 'altres', 'load', slot, drive)
+            self.mtx('-f', self.changer, 'altres', 'load', slot, drive)
         except sh.ErrorReturnCode_1:
             raise DriveAlreadyLoaded()
+        self.refresh()
+        if slot in self.status:
+            self.status[slot] = {'full': False, 'drive': drive}
+            self.save_slot(slot)
 
     def unload_drive(self, slot=None, drive=0):
         """
@@ -98,14 +141,34 @@ class Changer(object):
         """
         try:
             if slot is None:
-                sh.mtx('-f', self.changer, 'altres', 'unload')
+                if drive != 0:
+                    # mtx only takes a drive number after a slot number
+                    raise FailedToUnloadDrive()
+                self.mtx('-f', self.changer, 'altres', 'unload')
             else:
-                sh.mtx('-f', self.changer, 'altres', 'unload', slot)
+                self.mtx('-f', self.changer, 'altres', 'unload', slot, drive)
         except sh.ErrorReturnCode_1:
             raise FailedToUnloadDrive()
+        self.refresh()
+        if slot is not None and slot in self.status:
+            self.status[slot] = {'full': True}
+            self.save_slot(slot)
+
+    def execute(self, move):
+        """
+        Carries out a single move, in the form Planner.plan returns them
+        """
+        if move['command'] == "import":
+            return self.load(move['slot'])
+        if move['command'] == "eject":
+            return self.eject(move['slot'])
+        if move['command'] == "load_drive":
+            return self.load_drive(move['slot'], move.get('drive', 0))
+        if move['command'] == "unload_drive":
+            return self.unload_drive(move['slot'], move.get('drive', 0))
 
     def get_status(self):
-        return self.status
+        return self.refresh()
 
 
 class IncorrectDeviceTypeError(Exception):
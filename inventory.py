@@ -0,0 +1,44 @@
+"""Keeps the changer's inventory in redis, where every process can read it"""
+import json
+import time
+
+
+class Inventory(object):
+    """The authoritative record of what's in each of the changer's slots.
+
+    Changer keeps it up to date after every move, so a full `mtx status` scan is only needed
+    the first time or when someone asks for one."""
+
+    def __init__(self, redis, prefix="ripper:changer"):
+        self.redis = redis
+        self.prefix = prefix
+
+    def key(self, name):
+        return "%s:%s" % (self.prefix, name)
+
+    def load(self):
+        """Returns the slot statuses and the import/export slot"""
+        slots = self.redis.hgetall(self.key("slots"))
+        status = {slot: json.loads(state) for slot, state in slots.items()}
+        return status, self.redis.get(self.key("ioslot"))
+
+    def save(self, status, ioslot):
+        """Replaces the whole inventory after a full scan"""
+        pipe = self.redis.pipeline()
+        pipe.delete(self.key("slots"))
+        if status:
+            pipe.hmset(self.key("slots"), {slot: json.dumps(state)
+                                           for slot, state in status.items()})
+        if ioslot is not None:
+            pipe.set(self.key("ioslot"), ioslot)
+        pipe.set(self.key("scanned"), time.time())
+        pipe.execute()
+
+    def save_slot(self, slot, state):
+        """Records the new state of a single slot after a move"""
+        self.redis.hset(self.key("slots"), slot, json.dumps(state))
+
+    def scanned(self):
+        """When the last full scan happened, or None if there's never been one"""
+        scanned = self.redis.get(self.key("scanned"))
+        return None if scanned is None else float(scanned)
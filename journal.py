@@ -0,0 +1,103 @@
+"""Keeps track of how far through a disc a rip got, so it can pick up where it left off"""
+import fcntl
+import json
+import os
+import audiotools
+import config
+
+
+class Journal(object):
+    """A per-disc record of the tracks that are done, rewritten atomically as each one finishes.
+
+    For each finished track it keeps the files written and the checksums and log from reading
+    it; for tracks that were being encoded, the files that might be half written.
+
+    Two copies of the same pressing would share a journal (and their output files), so opening
+    one waits until nobody else has it open, calling waiting first if it has to. close() has to
+    be called when the rip is over, one way or another."""
+
+    def __init__(self, directory, disc_key, toc, waiting=None):
+        self.path = os.path.join(os.path.expanduser(directory), "%s.json" % disc_key)
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        # the lock file stays behind, since removing it would let the next rip lock a new one
+        self.lock = open("%s.lock" % self.path, "a")
+        try:
+            fcntl.flock(self.lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            if waiting is not None:
+                waiting()
+            fcntl.flock(self.lock, fcntl.LOCK_EX)
+        self.state = {'disc': disc_key, 'toc': toc, 'tracks': {}, 'partial': {}}
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                state = json.load(f)
+            if state.get('toc') == toc:
+                self.state = state
+
+    def save(self):
+        directory = os.path.dirname(self.path)
+        os.makedirs(directory, exist_ok=True)
+        temporary = "%s.tmp" % self.path
+        with open(temporary, "w") as f:
+            json.dump(self.state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary, self.path)
+
+    def discard_partial(self):
+        """Deletes whatever the last attempt left half written"""
+        for filenames in self.state['partial'].values():
+            for filename in filenames:
+                if os.path.exists(filename):
+                    os.remove(filename)
+        self.state['partial'] = {}
+        self.save()
+
+    def started(self, track_number, filenames):
+        """Notes the files a track is about to be encoded to"""
+        self.state['partial'][str(track_number)] = filenames
+        self.save()
+
+    def completed(self, track_number, filenames, log, checksums_v1, checksums_v2):
+        """Notes that a track's files are all encoded and tagged"""
+        self.state['partial'].pop(str(track_number), None)
+        self.state['tracks'][str(track_number)] = {'files': filenames,
+                                                   'log': log,
+                                                   'accuraterip_v1': checksums_v1,
+                                                   'accuraterip_v2': checksums_v2}
+        self.save()
+
+    def verified(self, track_number, filenames, track_length):
+        """Returns what was recorded about a track if it was finished before and every one of
+        filenames is still there with the right length, otherwise None"""
+        track = self.state['tracks'].get(str(track_number))
+        if track is None or track['files'] != filenames:
+            return None
+        for filename in filenames:
+            try:
+                if audiotools.open(filename).total_frames() != track_length:
+                    return None
+            except (IOError, audiotools.UnsupportedFile, audiotools.InvalidFile):
+                return None
+        return track
+
+    def finish(self):
+        """The disc is done, so there's nothing left to resume"""
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def close(self):
+        """Lets the next rip of the disc have the journal"""
+        if not self.lock.closed:
+            fcntl.flock(self.lock, fcntl.LOCK_UN)
+            self.lock.close()
+
+
+def open_journal(app, disc_key, cddareader, waiting=None):
+    """Opens the journal for the disc in cddareader, in ripper.journal_directory, waiting for
+    any other rip of the same disc to finish"""
+    toc = [[track_number, cddareader.track_offsets[track_number],
+            cddareader.track_lengths[track_number]]
+           for track_number in sorted(cddareader.track_offsets)]
+    return Journal(config.option(app, 'ripper', 'journal_directory',
+                                 '~/.cache/discripper/journal'), disc_key, toc, waiting)
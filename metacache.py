@@ -0,0 +1,111 @@
+"""Caches metadata lookups locally, so a disc only ever gets looked up once"""
+import config
+import json
+import os
+import sqlite3
+import time
+
+
+# all audiotools fills in when no lookup found the disc (or none could be reached)
+PLACEHOLDER_FIELDS = {'track_number', 'track_total'}
+
+
+def is_placeholder(choices):
+    """Whether cached choices are only audiotools' made up "no match" metadata"""
+    return all(set(fields) <= PLACEHOLDER_FIELDS for choice in choices for fields in choice)
+
+
+class MetadataCache(object):
+    """A SQLite cache of metadata_choices keyed by disc, which also remembers what's in each slot.
+
+    Entries expire after ttl seconds, or miss_ttl if the lookup found nothing, since that could
+    just as well have been the server turning us away. Once there are more than size of them
+    the least recently used ones are thrown out."""
+
+    def __init__(self, path, ttl, size, miss_ttl=60 * 60):
+        self.path = os.path.expanduser(path)
+        self.ttl = ttl
+        self.size = size
+        self.miss_ttl = miss_ttl
+        if os.path.dirname(self.path) != "":
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with self.connect() as db:
+            db.execute("CREATE TABLE IF NOT EXISTS discs (key TEXT PRIMARY KEY, choices TEXT, "
+                       "fetched REAL, accessed REAL)")
+            db.execute("CREATE INDEX IF NOT EXISTS discs_accessed ON discs (accessed)")
+            db.execute("CREATE TABLE IF NOT EXISTS slots (slot TEXT PRIMARY KEY, key TEXT)")
+
+    def connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def get(self, key):
+        """Returns the cached metadata_choices for a disc, or None if it isn't cached"""
+        # the webapp uses the cache too, and never needs audiotools otherwise
+        import audiotools
+        now = time.time()
+        with self.connect() as db:
+            row = db.execute("SELECT choices, fetched FROM discs WHERE key = ? AND fetched > ?",
+                             (key, now - self.ttl)).fetchone()
+            if row is None:
+                return None
+            choices = json.loads(row[0])
+            if is_placeholder(choices) and row[1] <= now - self.miss_ttl:
+                return None
+            db.execute("UPDATE discs SET accessed = ? WHERE key = ?", (now, key))
+        return [[audiotools.MetaData(**fields) for fields in choice] for choice in choices]
+
+    def put(self, key, metadata_choices):
+        """Caches the metadata_choices for a disc"""
+        choices = [[{attr: field for attr, field in metadata.filled_fields()}
+                    for metadata in choice]
+                   for choice in metadata_choices]
+        now = time.time()
+        with self.connect() as db:
+            db.execute("INSERT OR REPLACE INTO discs VALUES (?, ?, ?, ?)",
+                       (key, json.dumps(choices), now, now))
+            db.execute("DELETE FROM discs WHERE key IN (SELECT key FROM discs "
+                       "ORDER BY accessed DESC LIMIT -1 OFFSET ?)", (self.size,))
+
+    def lookup(self, key, cddareader):
+        """Returns the metadata_choices for the disc in cddareader, looking it up if necessary"""
+        import audiotools
+        metadata_choices = self.get(key)
+        if metadata_choices is None:
+            metadata_choices = audiotools.cddareader_metadata_lookup(cddareader)
+            self.put(key, metadata_choices)
+        return metadata_choices
+
+    def set_slot(self, slot, key):
+        """Remembers which disc is in a slot"""
+        with self.connect() as db:
+            db.execute("INSERT OR REPLACE INTO slots VALUES (?, ?)", (str(slot), key))
+
+    def forget_slot(self, slot):
+        with self.connect() as db:
+            db.execute("DELETE FROM slots WHERE slot = ?", (str(slot),))
+
+    def slot_key(self, slot):
+        with self.connect() as db:
+            row = db.execute("SELECT key FROM slots WHERE slot = ?", (str(slot),)).fetchone()
+        return None if row is None else row[0]
+
+    def annotate(self, status):
+        """Adds the album and artist of every slot we know the contents of to a changer status"""
+        with self.connect() as db:
+            rows = db.execute("SELECT slots.slot, discs.choices FROM slots "
+                              "JOIN discs ON slots.key = discs.key").fetchall()
+        for slot, choices in rows:
+            if slot in status and status[slot].get('full'):
+                first_track = json.loads(choices)[0][0]
+                status[slot]['album'] = first_track.get('album_name')
+                status[slot]['artist'] = first_track.get('artist_name')
+        return status
+
+
+def make_metadata_cache(app):
+    """Opens the metadata cache configured in the ripper section"""
+    return MetadataCache(
+        config.option(app, 'ripper', 'metadata_cache', '~/.cache/discripper/metadata.sqlite'),
+        config.option(app, 'ripper', 'metadata_cache_ttl', 30 * 24 * 60 * 60, float),
+        config.option(app, 'ripper', 'metadata_cache_size', 10000, int),
+        config.option(app, 'ripper', 'metadata_cache_miss_ttl', 60 * 60, float))
@@ -0,0 +1,138 @@
+"""Counters for how the rips are going, in redis, served up for Prometheus by the webapp"""
+import time
+
+
+# name: (type, help)
+METRICS = {
+    'ripper_stage_seconds_total': ('counter', "Time spent in each stage of ripping"),
+    'ripper_stage_bytes_total': ('counter', "PCM bytes that went through each stage"),
+    'ripper_stage_calls_total': ('counter', "Times each stage ran"),
+    'ripper_read_errors_total': ('counter', "Error counters from the drive's read log"),
+    'ripper_tracks_total': ('counter', "Tracks ripped"),
+    'ripper_discs_total': ('counter', "Discs ripped"),
+    'ripper_mtx_seconds_total': ('counter', "Time spent running mtx commands"),
+    'ripper_mtx_calls_total': ('counter', "mtx commands run"),
+    'ripper_mtx_failures_total': ('counter', "mtx commands that failed"),
+}
+
+# CD audio is 16 bit stereo
+BYTES_PER_FRAME = 4
+
+
+def labels(**values):
+    """Formats label values the way Prometheus wants them"""
+    return ",".join('%s="%s"' % (name, str(value).replace("\\", "\\\\").replace('"', '\\"')
+                                 .replace("\n", "\\n"))
+                    for name, value in sorted(values.items()))
+
+
+class Metrics(object):
+    """Keeps each metric in a redis hash of its label sets, so every worker adds to the same
+    counters and any web process can serve them"""
+
+    def __init__(self, redis, prefix="ripper:metrics"):
+        self.redis = redis
+        self.prefix = prefix
+
+    def key(self, name):
+        return "%s:%s" % (self.prefix, name)
+
+    def add(self, increments):
+        """Adds up a list of (name, labels, amount) in one round trip"""
+        pipe = self.redis.pipeline(transaction=False)
+        for name, label_set, amount in increments:
+            if amount:
+                pipe.hincrbyfloat(self.key(name), label_set, amount)
+        pipe.execute()
+
+    def stages(self, device, stages):
+        """Adds the totals a StageTimer reported for a rip on device"""
+        increments = []
+        for stage, totals in stages.items():
+            label_set = labels(device=device, stage=stage)
+            increments += [('ripper_stage_seconds_total', label_set, totals['seconds']),
+                           ('ripper_stage_bytes_total', label_set,
+                            totals['frames'] * BYTES_PER_FRAME),
+                           ('ripper_stage_calls_total', label_set, totals['calls'])]
+        self.add(increments)
+
+    def track(self, device, log):
+        """Counts a ripped track and the errors in the log from reading it"""
+        increments = [('ripper_tracks_total', labels(device=device), 1)]
+        for counter, value in log.items():
+            if isinstance(value, (int, float)):
+                increments.append(('ripper_read_errors_total',
+                                   labels(device=device, counter=counter), value))
+        self.add(increments)
+
+    def disc(self, device):
+        self.add([('ripper_discs_total', labels(device=device), 1)])
+
+    def mtx(self, command, seconds, failed):
+        label_set = labels(command=command)
+        self.add([('ripper_mtx_seconds_total', label_set, seconds),
+                  ('ripper_mtx_calls_total', label_set, 1),
+                  ('ripper_mtx_failures_total', label_set, 1 if failed else 0)])
+
+    def render(self, gauges=()):
+        """Returns every metric in Prometheus' text format, along with gauges, a list of
+        (name, help, {labels: value}) worked out at scrape time"""
+        pipe = self.redis.pipeline(transaction=False)
+        for name in sorted(METRICS):
+            pipe.hgetall(self.key(name))
+        lines = []
+        for (name, values) in zip(sorted(METRICS), pipe.execute()):
+            kind, description = METRICS[name]
+            lines += self.family(name, kind, description, values)
+        for name, description, values in gauges:
+            lines += self.family(name, 'gauge', description, values)
+        return "\n".join(lines) + "\n"
+
+    def family(self, name, kind, description, values):
+        lines = ["# HELP %s %s" % (name, description), "# TYPE %s %s" % (name, kind)]
+        for label_set in sorted(values):
+            lines.append("%s{%s} %s" % (name, label_set, float(values[label_set])))
+        return lines
+
+
+class StageRecorder(object):
+    """Passes on what a StageTimer has added up since the last flush, so a long rip shows up
+    in the metrics as it goes rather than all at the end"""
+
+    def __init__(self, metrics, timer, device):
+        self.metrics = metrics
+        self.timer = timer
+        self.device = device
+        self.flushed = {}
+
+    def flush(self):
+        report = self.timer.report()
+        changes = {}
+        for stage, totals in report.items():
+            last = self.flushed.get(stage, {'seconds': 0.0, 'frames': 0, 'calls': 0})
+            changes[stage] = {counter: totals[counter] - last[counter]
+                              for counter in ('seconds', 'frames', 'calls')}
+        self.metrics.stages(self.device, changes)
+        self.flushed = report
+
+
+class TimedMtx(object):
+    """Wraps the mtx command a Changer runs, timing every call into metrics"""
+
+    def __init__(self, mtx, metrics):
+        self.mtx = mtx
+        self.metrics = metrics
+
+    def __call__(self, *args):
+        # the command comes after '-f', the device and 'altres'
+        command = str(args[3]) if len(args) > 3 else "unknown"
+        if command == "eepos" and "transfer" in args:
+            command = "transfer"
+        started = time.time()
+        failed = True
+        try:
+            result = self.mtx(*args)
+            failed = False
+            return result
+        finally:
+            self.metrics.mtx(command, time.time() - started, failed)
@@ -0,0 +1,255 @@
+"""Lets the encoders run on their own threads so the drive never waits on them"""
+import queue
+import time
+from concurrent.futures import ThreadPoolExecutor
+import audiotools
+from audiotools import pcm
+import billiard
+from stages import StageTimer
+
+
+class QueueReader(object):
+    """A PCMReader that hands out FrameLists another thread put into a bounded queue.
+
+    The queue is what keeps memory bounded: once it's full, put() blocks the reading thread
+    until the encoder catches up."""
+
+    def __init__(self, sample_rate, channels, channel_mask, bits_per_sample, maxsize):
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.channel_mask = channel_mask
+        self.bits_per_sample = bits_per_sample
+        self.queue = queue.Queue(maxsize)
+        self.buffer = pcm.empty_framelist(channels, bits_per_sample)
+        self.finished = False
+        self.closed = False
+        self.waited = 0.0
+
+    def put(self, framelist):
+        """Called from the reading side; silently drops the frames if the encoder went away"""
+        while not self.closed:
+            try:
+                self.queue.put(framelist, timeout=0.5)
+                return
+            except queue.Full:
+                pass
+
+    def finish(self):
+        """Marks the end of the stream"""
+        self.put(None)
+
+    def read(self, pcm_frames):
+        while self.buffer.frames == 0 and not self.finished:
+            started = time.time()
+            framelist = self.queue.get()
+            self.waited += time.time() - started
+            if framelist is None:
+                self.finished = True
+            else:
+                self.buffer = framelist
+        if self.buffer.frames <= pcm_frames:
+            framelist = self.buffer
+            self.buffer = pcm.empty_framelist(self.channels, self.bits_per_sample)
+            return framelist
+        (framelist, self.buffer) = self.buffer.split(pcm_frames)
+        return framelist
+
+    def close(self):
+        self.closed = True
+
+
+def encode_track(output_class, filename, pcmreader, quality, total_pcm_frames, metadata, timer):
+    """Encodes and tags a single track, making sure the reading side never blocks forever.
+
+    Time spent waiting on the reading side doesn't count towards encoding."""
+    started = time.time()
+    try:
+        track = output_class.from_pcm(filename, pcmreader, quality,
+                                      total_pcm_frames=total_pcm_frames)
+    finally:
+        pcmreader.close()
+    timer.add('encode', time.time() - started - pcmreader.waited, total_pcm_frames)
+    with timer.time('tag'):
+        track.set_metadata(metadata)
+    return track
+
+
+class EncoderPool(object):
+    """A pool of encoder threads fed by the thread reading the disc"""
+
+    def __init__(self, workers, queue_size, timer):
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.queue_size = queue_size
+        self.timer = timer
+
+    def encode(self, pcmreader, output_class, filename, quality, total_pcm_frames, metadata):
+        """Starts encoding a track, returning the QueueReader to put the track's PCM data into
+        and a future for the encoded track"""
+        reader = QueueReader(pcmreader.sample_rate, pcmreader.channels,
+                             pcmreader.channel_mask, pcmreader.bits_per_sample,
+                             self.queue_size)
+        future = self.executor.submit(encode_track, output_class, filename, reader, quality,
+                                      total_pcm_frames, metadata, self.timer)
+        return reader, future
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+
+
+class BytesQueueReader(QueueReader):
+    """The encoder process's end of a ProcessEncoderPool job, which gets raw PCM bytes"""
+
+    def __init__(self, chunks, sample_rate, channels, channel_mask, bits_per_sample):
+        QueueReader.__init__(self, sample_rate, channels, channel_mask, bits_per_sample, 1)
+        self.queue = chunks
+
+    def read(self, pcm_frames):
+        while self.buffer.frames == 0 and not self.finished:
+            started = time.time()
+            data = self.queue.get()
+            self.waited += time.time() - started
+            if data is None:
+                self.finished = True
+            else:
+                self.buffer = pcm.FrameList(data, self.channels, self.bits_per_sample,
+                                            False, True)
+        return QueueReader.read(self, pcm_frames)
+
+
+def encode_in_process(chunks, results, sample_rate, channels, channel_mask, bits_per_sample,
+                      output_class, filename, quality, total_pcm_frames, metadata):
+    """Runs in the encoder process, reporting any error and its timings back through results"""
+    timer = StageTimer()
+    try:
+        encode_track(output_class, filename,
+                     BytesQueueReader(chunks, sample_rate, channels, channel_mask,
+                                      bits_per_sample),
+                     quality, total_pcm_frames, metadata, timer)
+        results.put((None, timer.stages))
+    except Exception as err:
+        results.put((str(err), timer.stages))
+
+
+class ProcessEncoderJob(object):
+    """The reading side's end of a ProcessEncoderPool job"""
+
+    def __init__(self, queue_size, timer):
+        self.chunks = billiard.Queue(queue_size)
+        self.results = billiard.Queue()
+        self.timer = timer
+        self.done = False
+
+    def put(self, framelist):
+        # FrameLists can't be pickled, so they cross over as bytes
+        self.put_data(framelist.to_bytes(False, True))
+
+    def finish(self):
+        self.put_data(None)
+
+    def put_data(self, data):
+        while not self.done:
+            try:
+                self.chunks.put(data, timeout=0.5)
+                return
+            except queue.Full:
+                pass
+
+    def run(self, sample_rate, channels, channel_mask, bits_per_sample,
+            output_class, filename, quality, total_pcm_frames, metadata):
+        """Runs the encoder process to completion, on one of the pool's threads"""
+        process = billiard.Process(target=encode_in_process,
+                                   args=(self.chunks, self.results, sample_rate, channels,
+                                         channel_mask, bits_per_sample, output_class, filename,
+                                         quality, total_pcm_frames, metadata))
+        process.start()
+        try:
+            while True:
+                try:
+                    error, stages = self.results.get(timeout=1)
+                    for stage, totals in stages.items():
+                        self.timer.add(stage, totals['seconds'], totals['frames'],
+                                       totals['calls'])
+                    break
+                except queue.Empty:
+                    if not process.is_alive():
+                        error = "Encoder exited with code %s" % process.exitcode
+                        break
+            process.join()
+        finally:
+            self.done = True
+        if error is not None:
+            raise audiotools.EncodingError(error)
+        return audiotools.open(filename)
+
+
+class ProcessEncoderPool(EncoderPool):
+    """Like EncoderPool, but each track is encoded in a process of its own so the encoders can
+    use every core. At most workers of them run at once.
+
+    billiard's processes are used because celery's own worker processes can't start
+    multiprocessing ones."""
+
+    def encode(self, pcmreader, output_class, filename, quality, total_pcm_frames, metadata):
+        job = ProcessEncoderJob(self.queue_size, self.timer)
+        future = self.executor.submit(job.run, pcmreader.sample_rate, pcmreader.channels,
+                                      pcmreader.channel_mask, pcmreader.bits_per_sample,
+                                      output_class, filename, quality, total_pcm_frames,
+                                      metadata)
+        return job, future
+
+
+class Tee(object):
+    """Puts the same PCM data into several QueueReaders"""
+
+    def __init__(self, *readers):
+        self.readers = readers
+
+    def put(self, framelist):
+        for reader in self.readers:
+            reader.put(framelist)
+
+    def finish(self):
+        for reader in self.readers:
+            reader.finish()
+
+
+class ReplayGainStage(object):
+    """Works out track and album ReplayGain on a thread of its own, from a copy of the PCM data
+    going to the encoders.
+
+    Album gain needs every track to go through the same calculator in order, so it's a single
+    thread per disc rather than a pool."""
+
+    def __init__(self, sample_rate, queue_size, timer):
+        self.calculator = audiotools.ReplayGainCalculator(sample_rate)
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.queue_size = queue_size
+        self.timer = timer
+
+    def analyze(self, pcmreader):
+        """Queues up a track for analysis, returning the QueueReader to put its PCM data into"""
+        reader = QueueReader(pcmreader.sample_rate, pcmreader.channels,
+                             pcmreader.channel_mask, pcmreader.bits_per_sample,
+                             self.queue_size)
+        self.executor.submit(self.drain, reader)
+        return reader
+
+    def drain(self, reader):
+        started = time.time()
+        frames = []
+        track = self.calculator.to_pcm(reader)
+        try:
+            audiotools.transfer_data(track.read, lambda framelist: frames.append(framelist.frames))
+        finally:
+            track.close()
+        self.timer.add('replay_gain', time.time() - started - reader.waited, sum(frames))
+
+    def shutdown(self):
+        """Waits for whatever's been queued up to be analyzed, without wanting the results"""
+        self.executor.shutdown(wait=True)
+
+    def gains(self):
+        """Waits for every track to be analyzed, then returns their ReplayGain in order"""
+        self.executor.shutdown(wait=True)
+        return [audiotools.ReplayGain(track_gain, track_peak, album_gain, album_peak)
+                for (track_gain, track_peak, album_gain, album_peak) in self.calculator]
@@ -0,0 +1,144 @@
+"""Orders changer moves so the arm travels as little as possible"""
+import config
+
+
+class Planner(object):
+    """Plans batches of changer moves.
+
+    Moves are dicts in the same form mtx_command takes them: a command ("import", "eject",
+    "load_drive" or "unload_drive") plus a slot, and a drive for the drive commands. Elements
+    are placed along a line by number, with each drive at its configured position, and the
+    cost of a move is how far the arm has to go to pick the disc up plus how far it carries it.
+    """
+
+    def __init__(self, drive_positions, ioslot=None):
+        self.drive_positions = drive_positions
+        self.ioslot = ioslot
+
+    def position(self, element):
+        if element == "io":
+            return int(self.ioslot) if self.ioslot is not None else 0
+        if isinstance(element, tuple):
+            return self.drive_positions[element[1]]
+        return int(element)
+
+    def ends(self, move):
+        """Returns where a move picks its disc up from and where it puts it down. An import
+        with no slot yet goes down at None"""
+        command = move['command']
+        slot = None if move.get('slot') is None else str(move['slot'])
+        drive = ("drive", int(move.get('drive', 0)))
+        if command == "import":
+            return "io", slot
+        if command == "eject":
+            return slot, "io"
+        if command == "load_drive":
+            return slot, drive
+        if command == "unload_drive":
+            return drive, slot
+        raise ValueError("Unknown move %s" % command)
+
+    def cost(self, arm, move):
+        source, destination = self.ends(move)
+        return (abs(arm - self.position(source)) +
+                abs(self.position(source) - self.position(destination)))
+
+    def nearest_slot(self, status, full, near):
+        """Returns the slot closest to the element near that is (or isn't) full. Slots whose
+        disc is out in a drive aren't empty, whatever they say"""
+        candidates = [slot for slot in status
+                      if status[slot]['full'] is full and 'drive' not in status[slot]]
+        if len(candidates) == 0:
+            return None
+        return min(candidates, key=lambda slot: (abs(int(slot) - self.position(near)), int(slot)))
+
+    def coalesce(self, moves):
+        """Drops pairs of moves that undo each other, like loading a disc into a drive and
+        putting it straight back"""
+        moves = list(moves)
+        i = 0
+        while i < len(moves):
+            source, destination = self.ends(moves[i])
+            undone = False
+            for j in range(i + 1, len(moves)):
+                if self.ends(moves[j]) == (destination, source):
+                    del moves[j]
+                    del moves[i]
+                    undone = True
+                    break
+                if destination in self.ends(moves[j]) or source in self.ends(moves[j]):
+                    # something else touches these elements in between, so leave them
+                    break
+            if not undone:
+                i += 1
+        return moves
+
+    def plan(self, moves, status, arm=None):
+        """Orders moves so that each one is possible when it happens, picking the cheapest
+        possible move from wherever the arm is each time. Imports without a slot are given the
+        empty slot closest to the import/export slot.
+
+        Moves freeing a drive go first when it doesn't cost anything extra, so drives sit idle
+        as little as possible. Drives are taken to hold a disc when a slot's disc is out in
+        them."""
+        status = {slot: dict(state) for slot, state in status.items()}
+        drives = {("drive", drive): any(state.get('drive') == drive for state in status.values())
+                  for drive in range(len(self.drive_positions))}
+        pending = self.coalesce(moves)
+        arm = self.position("io") if arm is None else arm
+        planned = []
+        while pending:
+            ready = []
+            for move in pending:
+                resolved = move
+                if move['command'] == "import" and move.get('slot') is None:
+                    slot = self.nearest_slot(status, False, "io")
+                    if slot is None:
+                        raise ValueError("No empty slot to import into")
+                    resolved = dict(move, slot=slot)
+                if self.ready(resolved, status, drives):
+                    ready.append((move, resolved))
+            if len(ready) == 0:
+                raise ValueError("These moves can't all be done: %s" % pending)
+            move, resolved = min(ready, key=lambda ready: (
+                self.cost(arm, ready[1]), ready[1]['command'] != "unload_drive"))
+            pending.remove(move)
+            move = resolved
+            source, destination = self.ends(move)
+            for element, full in [(source, False), (destination, True)]:
+                if element in status:
+                    status[element]['full'] = full
+                if element in drives:
+                    drives[element] = full
+            if move['command'] == "load_drive" and source in status:
+                status[source]['drive'] = destination[1]
+            if move['command'] == "unload_drive" and destination in status:
+                status[destination].pop('drive', None)
+            arm = self.position(destination)
+            planned.append(move)
+        return planned
+
+    def ready(self, move, status, drives):
+        """Checks whether a move can happen now, given what's in each slot and drive. Moves
+        that aren't ready may become ready once other pending ones are done"""
+        source, destination = self.ends(move)
+        if source in status and not status[source]['full']:
+            # nothing to pick up, at least until a pending move puts something there
+            return False
+        if source in drives and not drives[source]:
+            return False
+        if destination in status and status[destination]['full']:
+            return False
+        if destination in drives and drives[destination]:
+            # the drive has to be emptied first
+            return False
+        return True
+
+
+def make_planner(app, ioslot=None):
+    """Builds a planner from ripper.drive_positions, which defaults to every drive sitting just
+    before the first slot"""
+    devices = config.option(app, 'ripper', 'drives', app.config['ripper'].get('cdrom'))
+    count = len([device for device in devices.split(",") if device.strip() != ""])
+    positions = config.option(app, 'ripper', 'drive_positions', ",".join(["0"] * count))
+    return Planner([int(position) for position in positions.split(",")], ioslot)
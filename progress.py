@@ -0,0 +1,107 @@
+"""Rate limited progress reporting for rips"""
+import json
+import time
+
+
+def disc_key(task_id):
+    """Where the static metadata about the disc a task is ripping is kept"""
+    return "ripper:task:%s:disc" % task_id
+
+
+def load_disc(redis, task_id):
+    """Returns the metadata a rip stored about its disc, or None if it hasn't got that far"""
+    disc = redis.get(disc_key(task_id))
+    return None if disc is None else json.loads(disc)
+
+
+class ProgressReporter(object):
+    """Reports a rip's progress through update_state.
+
+    The disc's metadata is only sent once; after that each update is just the track, how far
+    through the disc we are, the read rate and an ETA. Updates that come sooner than interval
+    seconds after the last one, or that moved less than step, are dropped.
+
+    Tracks that were skipped move the progress on, but the rate only counts the tracks really
+    read from the drive, over the time spent on them, so the ETA for what's left isn't thrown
+    off by however many tracks were skipped."""
+
+    def __init__(self, task, redis, interval=1.0, step=0.01):
+        self.task = task
+        self.redis = redis
+        self.interval = interval
+        self.step = step
+        self.total_frames = 0
+        self.done_frames = 0
+        self.track_frames = 0
+        self.read_frames = 0
+        self.read_seconds = 0.0
+        self.reading = False
+        self.track_started = time.time()
+        self.current = None
+        self.total = None
+        self.fraction = 0
+        self.last_sent = 0
+        self.last_fraction = None
+
+    def disc(self, album, artist, metadata, total, total_frames):
+        """Sends the static metadata about the disc, the one time it's sent"""
+        disc = {'album': album, 'artist': artist, 'metadata': metadata, 'total': total}
+        self.redis.set(disc_key(self.task.request.id), json.dumps(disc), ex=7 * 24 * 60 * 60)
+        self.total = total
+        self.total_frames = total_frames
+        self.task.update_state(state='PROGRESS', meta={'disc': disc,
+                                                       'current': None,
+                                                       'total': total,
+                                                       'status': 'Got metadata, preparing to rip'})
+
+    def track(self, track_number, track_length, status, skipped=False):
+        """Moves on to the next track, which won't be read from the drive if it's skipped"""
+        now = time.time()
+        if self.reading:
+            self.read_frames += self.track_frames
+            self.read_seconds += now - self.track_started
+        self.done_frames += self.track_frames
+        self.track_frames = track_length
+        self.reading = not skipped
+        self.track_started = now
+        self.current = track_number
+        self.send(status, force=True)
+
+    def progress(self, fraction, status='Ripping...'):
+        """Reports how far through the current track we are"""
+        self.send(status, fraction)
+
+    def status(self, status):
+        """Reports a change of status, which is always sent"""
+        self.send(status, force=True)
+
+    def send(self, status, track_fraction=0, force=False):
+        now = time.time()
+        done_frames = self.done_frames + track_fraction * self.track_frames
+        if self.total_frames > 0:
+            fraction = done_frames / self.total_frames
+        else:
+            fraction = 0
+        if not force:
+            if now - self.last_sent < self.interval:
+                return
+            if self.last_fraction is not None and fraction - self.last_fraction < self.step:
+                return
+        read_frames = self.read_frames
+        read_seconds = self.read_seconds
+        if self.reading:
+            read_frames += track_fraction * self.track_frames
+            read_seconds += now - self.track_started
+        rate = read_frames / read_seconds if read_seconds > 0 else 0
+        if rate > 0:
+            eta = (self.total_frames - done_frames) / rate
+        else:
+            eta = None
+        self.task.update_state(state='PROGRESS', meta={'current': self.current,
+                                                       'total': self.total,
+                                                       'progress': fraction,
+                                                       'rate': rate,
+                                                       'eta': eta,
+                                                       'status': status})
+        self.last_sent = now
+        self.last_fraction = fraction
@@ -0,0 +1,8 @@
+"""Connects flask and the celery workers to the redis server they share"""
+import redis
+
+
+def make_redis(app):
+    """Connects to REDIS_URL, falling back to the celery result backend if it's not set"""
+    url = app.config.get('REDIS_URL', app.config['CELERY_RESULT_BACKEND'])
+    return redis.StrictRedis.from_url(url, decode_responses=True)
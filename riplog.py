@@ -0,0 +1,141 @@
+"""Keeps the log of every rip, so problems can be spotted across the whole collection"""
+import os
+import sqlite3
+import time
+import config
+
+
+# the read log counters that get a column each. These are the schema, so they're spelled out
+# here rather than taken from securerip, which would drag audiotools into the webapp
+ERROR_COUNTERS = ('readerr', 'skip', 'scratch', 'repair', 'fixup_dropped', 'fixup_duped')
+SECURE_COUNTERS = ('rereads', 'unresolved')
+
+
+class RipLog(object):
+    """An append-only SQLite store with a row for every rip, every track it read and every stage
+    it timed. Each counter is a column of its own, so the queries can add them up without
+    unpacking anything"""
+
+    def __init__(self, path):
+        self.path = os.path.expanduser(path)
+        if os.path.dirname(self.path) != "":
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        counters = ", ".join("%s INTEGER" % counter
+                             for counter in ERROR_COUNTERS + SECURE_COUNTERS)
+        with self.connect() as db:
+            db.execute("CREATE TABLE IF NOT EXISTS rips (id INTEGER PRIMARY KEY, disc TEXT, "
+                       "task TEXT, device TEXT, slot TEXT, album TEXT, artist TEXT, "
+                       "frames INTEGER, started REAL, finished REAL)")
+            db.execute("CREATE TABLE IF NOT EXISTS tracks (rip INTEGER, track_number INTEGER, "
+                       "frames INTEGER, seconds REAL, speed INTEGER, reused INTEGER, %s, "
+                       "accuraterip_v1 INTEGER, accuraterip_v2 INTEGER, "
+                       "confidence INTEGER, confidence_total INTEGER, "
+                       "accuraterip_offset INTEGER)" % counters)
+            db.execute("CREATE TABLE IF NOT EXISTS stages (rip INTEGER, stage TEXT, "
+                       "seconds REAL, frames INTEGER, calls INTEGER)")
+            db.execute("CREATE INDEX IF NOT EXISTS rips_device ON rips (device, finished)")
+            db.execute("CREATE INDEX IF NOT EXISTS rips_disc ON rips (disc, finished)")
+            db.execute("CREATE INDEX IF NOT EXISTS tracks_rip ON tracks (rip)")
+            db.execute("CREATE INDEX IF NOT EXISTS tracks_speed ON tracks (speed)")
+            db.execute("CREATE INDEX IF NOT EXISTS stages_rip ON stages (rip, stage)")
+
+    def connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def record(self, rip, tracks, stages):
+        """Adds a rip. rip is a dict of the rips columns, tracks a list of dicts of the tracks
+        columns (where log is the read log and verified what accuraterip.confidence said, if
+        anything) and stages what a StageTimer reported"""
+        with self.connect() as db:
+            rip_id = db.execute("INSERT INTO rips (disc, task, device, slot, album, artist, "
+                                "frames, started, finished) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                (rip['disc'], rip['task'], rip['device'], rip['slot'],
+                                 rip['album'], rip['artist'], rip['frames'], rip['started'],
+                                 time.time())).lastrowid
+            columns = (('rip', 'track_number', 'frames', 'seconds', 'speed', 'reused') +
+                       ERROR_COUNTERS + SECURE_COUNTERS +
+                       ('accuraterip_v1', 'accuraterip_v2', 'confidence', 'confidence_total',
+                        'accuraterip_offset'))
+            rows = []
+            for track in tracks:
+                verified = track['verified'] or {}
+                rows.append((rip_id, track['track_number'], track['frames'], track['seconds'],
+                             track['speed'], 1 if track['reused'] else 0) +
+                            tuple(track['log'].get(counter, 0)
+                                  for counter in ERROR_COUNTERS + SECURE_COUNTERS) +
+                            (track['accuraterip_v1'], track['accuraterip_v2'],
+                             verified.get('confidence'), verified.get('total'),
+                             verified.get('offset')))
+            db.executemany("INSERT INTO tracks (%s) VALUES (%s)" % (
+                ", ".join(columns), ", ".join("?" * len(columns))), rows)
+            db.executemany("INSERT INTO stages VALUES (?, ?, ?, ?, ?)",
+                           [(rip_id, stage, totals['seconds'], totals['frames'], totals['calls'])
+                            for stage, totals in stages.items()])
+        return rip_id
+
+    def query(self, sql, parameters=()):
+        with self.connect() as db:
+            cursor = db.execute(sql, parameters)
+            names = [column[0] for column in cursor.description]
+            return [dict(zip(names, row)) for row in cursor.fetchall()]
+
+    def drives(self, since=0):
+        """Tracks read, errors and the error rate per sector for each drive"""
+        errors = " + ".join("COALESCE(SUM(tracks.%s), 0)" % counter for counter in ERROR_COUNTERS)
+        return self.query("SELECT rips.device AS device, COUNT(DISTINCT rips.id) AS discs, "
+                          "COUNT(*) AS tracks, SUM(tracks.frames) AS frames, "
+                          "{errors} AS errors, "
+                          "SUM(tracks.unresolved) AS unresolved, "
+                          "({errors}) * 588.0 / MAX(SUM(tracks.frames), 1) AS errors_per_sector "
+                          "FROM rips JOIN tracks ON tracks.rip = rips.id "
+                          "WHERE rips.finished >= ? AND tracks.reused = 0 "
+                          "GROUP BY rips.device "
+                          "ORDER BY errors_per_sector DESC".format(errors=errors), (since,))
+
+    def speeds(self, since=0):
+        """How fast tracks actually read, as multiples of realtime, at each speed setting"""
+        return self.query("SELECT tracks.speed AS speed, COUNT(*) AS tracks, "
+                          "SUM(tracks.frames) AS frames, SUM(tracks.seconds) AS seconds, "
+                          "SUM(tracks.frames) / 44100.0 / SUM(tracks.seconds) AS throughput "
+                          "FROM rips JOIN tracks ON tracks.rip = rips.id "
+                          "WHERE rips.finished >= ? AND tracks.reused = 0 "
+                          "AND tracks.seconds > 0 "
+                          "GROUP BY tracks.speed ORDER BY tracks.speed", (since,))
+
+    def rates(self, since=0):
+        """For each drive, how many frames a second it really reads and how many seconds a rip
+        spends on anything else, on average"""
+        rates = self.query("SELECT rips.device AS device, "
+                           "SUM(tracks.frames) / SUM(tracks.seconds) AS rate "
+                           "FROM rips JOIN tracks ON tracks.rip = rips.id "
+                           "WHERE rips.finished >= ? AND tracks.reused = 0 "
+                           "AND tracks.seconds > 0 GROUP BY rips.device", (since,))
+        overheads = self.query("SELECT rips.device AS device, "
+                               "AVG(rips.finished - rips.started - COALESCE("
+                               "(SELECT SUM(tracks.seconds) FROM tracks "
+                               "WHERE tracks.rip = rips.id AND tracks.reused = 0), 0)) "
+                               "AS overhead FROM rips WHERE rips.finished >= ? "
+                               "GROUP BY rips.device", (since,))
+        overheads = {row['device']: row['overhead'] for row in overheads}
+        return {row['device']: {'rate': row['rate'], 'overhead': overheads.get(row['device'])}
+                for row in rates}
+
+    def rerips(self, since=0):
+        """Discs whose latest rip has tracks that never read the same twice, or that
+        AccurateRip has submissions for but none that match"""
+        return self.query("SELECT rips.disc AS disc, rips.slot AS slot, rips.album AS album, "
+                          "rips.artist AS artist, rips.device AS device, "
+                          "rips.finished AS finished, "
+                          "GROUP_CONCAT(tracks.track_number) AS tracks "
+                          "FROM rips JOIN tracks ON tracks.rip = rips.id "
+                          "WHERE rips.finished >= ? AND rips.id = "
+                          "(SELECT MAX(latest.id) FROM rips AS latest "
+                          "WHERE latest.disc = rips.disc) "
+                          "AND (tracks.unresolved > 0 OR "
+                          "(tracks.confidence = 0 AND tracks.confidence_total > 0)) "
+                          "GROUP BY rips.id ORDER BY rips.finished DESC", (since,))
+
+
+def make_rip_log(app):
+    """Opens the store in ripper.rip_log"""
+    return RipLog(config.option(app, 'ripper', 'rip_log', '~/.cache/discripper/riplog.sqlite'))
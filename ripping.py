@@ -0,0 +1,575 @@
+"""Rips a disc, start to finish. Kept apart from tasks so only the workers that rip import
+audiotools and everything that goes with it"""
+import os
+import time
+from concurrent.futures import Future
+import audiotools
+from audiotools.ui import process_output_options
+from celery.exceptions import Ignore
+from pipeline import EncoderPool, ProcessEncoderPool, ReplayGainStage, Tee
+import checksum
+from securerip import SecureReader
+from splitter import DiscSplitter
+from journal import open_journal
+import discid
+from progress import ProgressReporter
+from stages import StageTimer, TimedReader
+from metrics import StageRecorder
+from speed import SpeedController
+from sinks import make_sink
+import dedup
+from accuraterip import make_mirror, confidence as accuraterip_confidence
+from riplog import make_rip_log
+import config
+import tasks
+from tasks import app
+
+
+PREVIOUS_TRACK_FRAMES = (5880 // 2)
+NEXT_TRACK_FRAMES = (5880 // 2)
+
+msg = audiotools.SilentMessenger()
+
+
+class AccurateRipReader(object):
+    def __init__(self, pcmreader, total_pcm_frames, is_first, is_last, timer):
+        """pcmreader is a PCMReader object to wrap around
+        total_pcm_frames is the length of pcmreader,
+        not including previous and next track frames
+        is_first and is_last indicate the track's position in the stream
+        timer is the StageTimer the checksumming is timed with"""
+
+        self.pcmreader = pcmreader
+        self.timer = timer
+
+        self.checksummer = checksum.Checksum(
+            total_pcm_frames=total_pcm_frames,
+            sample_rate=pcmreader.sample_rate,
+            is_first=is_first,
+            is_last=is_last,
+            pcm_frame_range=PREVIOUS_TRACK_FRAMES + 1 + NEXT_TRACK_FRAMES,
+            accurateripv2_offset=PREVIOUS_TRACK_FRAMES)
+
+        self.sample_rate = pcmreader.sample_rate
+        self.channels = pcmreader.channels
+        self.channel_mask = pcmreader.channel_mask
+        self.bits_per_sample = pcmreader.bits_per_sample
+
+    def read(self, pcm_frames):
+        frame = self.pcmreader.read(pcm_frames)
+        with self.timer.time('accuraterip', frame.frames):
+            self.checksummer.update(frame)
+        return frame
+
+    def close(self):
+        self.pcmreader.close()
+
+    def checksums_v1(self):
+        return self.checksummer.checksums_v1()
+
+    def checksums_v2(self):
+        return [self.checksummer.checksum_v2()]
+
+
+class CeleryProgressDisplay(audiotools.ProgressDisplay):
+    """A ProgressDisplay class to send status updates via a rate limited ProgressReporter"""
+    def __init__(self, messenger, reporter):
+        audiotools.ProgressDisplay.__init__(self, messenger)
+        self.reporter = reporter
+
+    def update(self, progress):
+        """updates the celery state with new progress value, if it's time to"""
+        self.reporter.progress(progress.numerator/progress.denominator)
+
+
+def output_formats():
+    """Returns the (output_class, quality) of each format in ripper.formats, which looks like
+    "flac:8,opus:10". Formats without a quality get their default one"""
+    formats = []
+    for entry in config.option(app, 'ripper', 'formats', 'wav').split(","):
+        if entry.strip() == "":
+            continue
+        name, _, quality = entry.strip().partition(":")
+        if name not in audiotools.TYPE_MAP:
+            raise ValueError("Unknown output format %s" % name)
+        output_class = audiotools.TYPE_MAP[name]
+        if quality == "":
+            quality = output_class.DEFAULT_COMPRESSION
+        elif quality not in output_class.COMPRESSION_MODES:
+            raise ValueError("%s doesn't have a quality %s" % (name, quality))
+        formats.append((output_class, quality))
+    return formats
+
+
+def lossless_source(tracks, cddareader):
+    """Returns the first of tracks that decodes to exactly what was read off the disc, or None
+    if they're all lossy or resampled"""
+    for track in tracks:
+        if track.lossless() and \
+                track.sample_rate() == cddareader.sample_rate and \
+                track.channels() == cddareader.channels and \
+                track.bits_per_sample() == cddareader.bits_per_sample:
+            return track
+    return None
+
+
+def jsonify_metadata(metadatas):
+    out = []
+    for metadata in metadatas:
+        out.append({attr: field for attr, field in metadata.filled_fields()})
+    return out
+
+
+def merge_metadatas(metadatas):
+    if len(metadatas) == 0:
+        return audiotools.MetaData()
+    elif len(metadatas) == 1:
+        return metadatas[0]
+    else:
+        merged = metadatas[0]
+        for to_merge in metadatas[1:]:
+            merged = merged.intersection(to_merge)
+        return merged
+
+
+def rip(self, device, slot=None):
+    """Rips the disc in device, holding its journal until it's done"""
+    started = time.time()
+    timer = StageTimer()
+    try:
+        cddareader = TimedReader(tasks.open_cddareader(device), timer, 'read')
+        disc_key = discid.toc_key(cddareader)
+        journal = open_journal(app, disc_key, cddareader, lambda: self.update_state(
+            state='PROGRESS', meta={'status': 'Waiting for another drive ripping this disc'}))
+    except (IOError, ValueError, OSError) as err:
+        self.update_state(state='FAILURE', meta={'error': str(err)})
+        raise Ignore()
+    try:
+        return rip_disc(self, device, slot, cddareader, disc_key, journal, timer, started)
+    finally:
+        journal.close()
+
+
+def rip_disc(self, device, slot, cddareader, disc_key, journal, timer, started):
+    """Most of this is just copied from cdda2track, a part of python-audio-tools"""
+    recorder = StageRecorder(tasks.metrics, timer, device)
+    accuraterip_ids = discid.accuraterip_ids(cddareader)
+    track_offsets = cddareader.track_offsets
+    track_lengths = cddareader.track_lengths
+
+    read_offset = config.option(app, 'ripper', 'offset', 0, int)
+    speed = config.option(app, 'ripper', 'speed', kind=int)
+    if speed is not None:
+        cddareader.set_speed(speed)
+
+    pre_gap_length = cddareader.track_offsets[1]
+    if pre_gap_length > 0:
+        with audiotools.BufferedPCMReader(audiotools.PCMReaderWindow(cddareader,
+                                                                     read_offset,
+                                                                     pre_gap_length,
+                                                                     forward_close=False)) as r:
+            preserve_pre_gap = not checksum.is_silent(r.read(pre_gap_length))
+            if preserve_pre_gap:
+                track_offsets[0] = 0
+                track_lengths[0] = pre_gap_length
+    else:
+        preserve_pre_gap = False
+
+    reporter = ProgressReporter(self, tasks.redis,
+                                config.option(app, 'ripper', 'progress_interval', 1.0, float),
+                                config.option(app, 'ripper', 'progress_step', 0.01, float))
+    reporter.status('Reading metadata')
+    with timer.time('metadata'):
+        metadata_choices = tasks.metadata_cache.lookup(disc_key, cddareader)
+    if slot is not None:
+        tasks.metadata_cache.set_slot(slot, disc_key)
+        tasks.scheduler.remember_frames(slot, discid.total_frames(cddareader))
+
+    if preserve_pre_gap:
+        # prepend "track 0" track to start of list for each choice
+        for choice in metadata_choices:
+            track_0 = merge_metadatas(choice)
+            track_0.track_number = 0
+            choice.insert(0, track_0)
+
+    album = metadata_choices[0][0].album_name
+    artist = metadata_choices[0][0].artist_name
+    tracks_to_rip = list(sorted(track_offsets.keys()))
+    reporter.disc(album, artist, jsonify_metadata(metadata_choices[0]), len(tracks_to_rip),
+                  sum(track_lengths[track_number] for track_number in tracks_to_rip))
+
+    try:
+        formats = output_formats()
+        # every format gets written from the one read of the disc
+        output_tracks = [list(
+            process_output_options(
+                metadata_choices=[
+                    [c for i, c in
+                     enumerate(choices, 0 if preserve_pre_gap else 1)
+                     if i in tracks_to_rip]
+                    for choices in metadata_choices],
+                input_filenames=[
+                    audiotools.Filename("track{:02d}.cdda.wav".format(i))
+                    for i in tracks_to_rip],
+                output_directory=app.config['ripper']['output_directory'],
+                format_string=config.option(app, 'ripper', 'format_string'),
+                output_class=output_class,
+                quality=quality,
+                msg=msg,
+                use_default=True))
+            for output_class, quality in formats]
+        sink = make_sink(app, timer)
+        if config.flag(app, 'ripper', 'dedup') and not sink.keeps_files:
+            # the index points at the encoded files, and this sink deletes them once they're
+            # uploaded
+            sink.shutdown()
+            raise ValueError("ripper.dedup needs a sink that keeps the files, like directory")
+    except (audiotools.UnsupportedTracknameField, ValueError, ImportError) as err:
+        self.update_state(state='FAILURE', meta={'error': str(err)})
+        raise Ignore()
+
+    rip_log = {}
+    # how long the drive spent on each track that was read, and at what speed
+    track_seconds = {}
+    track_speeds = {}
+    accuraterip_log_v1 = {}
+    accuraterip_log_v2 = {}
+    if config.flag(app, 'ripper', 'replay_gain', True):
+        replay_gain = ReplayGainStage(cddareader.sample_rate,
+                                      config.option(app, 'ripper', 'pcm_queue_size', 256, int),
+                                      timer)
+    else:
+        replay_gain = None
+
+    if config.flag(app, 'ripper', 'adaptive_speed'):
+        # fast where the disc reads cleanly, slow where it doesn't
+        reader = SpeedController(
+            cddareader,
+            [int(speed) for speed in
+             config.option(app, 'ripper', 'speeds', '48,32,24,16,8,4').split(",")],
+            config.option(app, 'ripper', 'speed_block_sectors', 750, int) * 588,
+            config.option(app, 'ripper', 'speed_clean_blocks', 3, int))
+        speed_profile = reader.profile
+    else:
+        reader = cddareader
+        speed_profile = None
+
+    if config.flag(app, 'ripper', 'secure'):
+        # only blocks the drive reports trouble with get read more than once
+        reader = SecureReader(reader,
+                              config.option(app, 'ripper', 'secure_block_sectors', 75, int),
+                              config.option(app, 'ripper', 'secure_max_rereads', 16, int),
+                              flush_distance=config.option(app, 'ripper',
+                                                           'secure_flush_distance', 10000, int),
+                              flush_sectors=config.option(app, 'ripper', 'secure_flush_sectors',
+                                                          75, int))
+
+    if config.flag(app, 'ripper', 'single_pass'):
+        # read the disc once, start to finish, and cut the tracks out of that
+        splitter = DiscSplitter(reader,
+                                config.option(app, 'ripper', 'single_pass_block_sectors', 300,
+                                              int) * 588,
+                                PREVIOUS_TRACK_FRAMES + NEXT_TRACK_FRAMES)
+    else:
+        splitter = None
+
+    # the drive keeps reading the next track while the pool encodes the finished ones
+    if config.flag(app, 'ripper', 'encoder_processes'):
+        encoder_pool = ProcessEncoderPool
+    else:
+        encoder_pool = EncoderPool
+    # every format of a track is fed at once, so they all need a worker at the same time or the
+    # reader blocks on a queue nobody is draining
+    encoders = encoder_pool(max(config.option(app, 'ripper', 'encoders', os.cpu_count(), int),
+                                len(formats)),
+                            config.option(app, 'ripper', 'pcm_queue_size', 256, int),
+                            timer)
+    encoding = []
+
+    # anything a crashed attempt was in the middle of writing gets redone
+    journal.discard_partial()
+    unjournaled = []
+
+    if config.flag(app, 'ripper', 'dedup'):
+        dedup_index = dedup.make_dedup_index(app)
+        probe_frames = config.option(app, 'ripper', 'dedup_probe_sectors', 75, int) * 588
+        format_names = ["%s:%s" % (output_class.NAME, quality)
+                        for output_class, quality in formats]
+    else:
+        dedup_index = None
+    probes = {}
+
+    def journal_finished():
+        """Records every track whose encoders have all finished in the journal, and the dedup
+        index"""
+        for entry in list(unjournaled):
+            track_number, filenames, tracks = entry
+            if all(track.done() and track.exception() is None for track in tracks):
+                journal.completed(track_number, filenames, rip_log[track_number],
+                                  accuraterip_log_v1[track_number],
+                                  accuraterip_log_v2[track_number])
+                if dedup_index is not None:
+                    dedup_index.add(disc_key, track_number, track_lengths[track_number],
+                                    probes[track_number], format_names, filenames,
+                                    rip_log[track_number], accuraterip_log_v1[track_number],
+                                    accuraterip_log_v2[track_number])
+                unjournaled.remove(entry)
+
+    def window(start, length):
+        """Returns a PCMReader for length frames of the disc from start"""
+        if splitter is not None:
+            return splitter.window(start, length)
+        seeked_offset = reader.seek(max(start, 0))
+        return audiotools.PCMReaderWindow(reader, start - seeked_offset, length,
+                                          forward_close=False)
+
+    def probe(track_number):
+        """Reads the stretch of a track the dedup index knows it by"""
+        start, length = dedup.probe_range(track_lengths[track_number], probe_frames)
+        return dedup.digest(window(start + track_offsets[track_number] + read_offset, length))
+
+    for index, track_number in enumerate(tracks_to_rip):
+        track_length = track_lengths[track_number]
+        filenames = [str(tracks[index][1]) for tracks in output_tracks]
+
+        # skip whatever an earlier attempt already finished
+        finished = journal.verified(track_number, filenames, track_length)
+        status = 'Already ripped'
+        if finished is None and dedup_index is not None and \
+                dedup_index.candidates(track_length, format_names):
+            # or that's already in the archive, from this disc or any other
+            probes[track_number] = probe(track_number)
+            finished = dedup_index.find(disc_key, track_number, track_length,
+                                        probes[track_number], format_names)
+            if finished is not None:
+                status = 'Already in the archive'
+                same_track = (finished['disc'] == disc_key and
+                              finished['track_number'] == track_number)
+                for source, filename, output_track in zip(
+                        finished['files'], filenames, [tracks[index] for tracks in output_tracks]):
+                    if same_track:
+                        dedup.link(source, filename)
+                    else:
+                        # another album's file, so it needs this album's tags, and whatever's
+                        # written to it mustn't change the original
+                        dedup.copy(source, filename)
+                        with timer.time('tag'):
+                            audiotools.open(filename).set_metadata(output_track[3])
+                journal.completed(track_number, filenames, finished['log'],
+                                  finished['accuraterip_v1'], finished['accuraterip_v2'])
+        if finished is not None:
+            reporter.track(track_number, track_length, status, skipped=True)
+            rip_log[track_number] = finished['log']
+            accuraterip_log_v1[track_number] = finished['accuraterip_v1']
+            accuraterip_log_v2[track_number] = finished['accuraterip_v2']
+            track_encodings = []
+            for filename in filenames:
+                track = Future()
+                track.set_result(audiotools.open(filename))
+                track_encodings.append(track)
+                if replay_gain is None:
+                    sink.store_when_done(track, filename)
+            encoding.append(track_encodings)
+            if replay_gain is not None:
+                # album gain still needs to hear the track, just as it came off the disc, so
+                # lossy or resampled files won't do; without a lossless one it's read again
+                source = lossless_source([track.result() for track in track_encodings],
+                                         cddareader)
+                if source is not None:
+                    track_pcm = source.to_pcm()
+                else:
+                    track_pcm = window(track_offsets[track_number] + read_offset, track_length)
+                try:
+                    gain_input = replay_gain.analyze(track_pcm)
+                    audiotools.transfer_data(track_pcm.read, gain_input.put)
+                    gain_input.finish()
+                finally:
+                    track_pcm.close()
+            continue
+
+        reporter.track(track_number, track_length, 'Preparing to rip')
+        read_seconds = timer.seconds('read')
+        reader.reset_log()
+        track_offset = (track_offsets[track_number] +
+                        read_offset -
+                        PREVIOUS_TRACK_FRAMES)
+
+        # make leading directories, if necessary
+        try:
+            for tracks in output_tracks:
+                audiotools.make_dirs(str(tracks[index][1]))
+        except OSError as err:
+            encoders.shutdown()
+            sink.shutdown()
+            self.update_state(state='FAILURE', meta={'error': str(err)})
+            raise Ignore()
+
+        # setup individual progress bar per track
+        progress = CeleryProgressDisplay(msg, reporter)
+
+        # perform extraction over an AccurateRip window
+        if splitter is not None:
+            track_data = splitter.window(
+                track_offset,
+                PREVIOUS_TRACK_FRAMES + track_length + NEXT_TRACK_FRAMES)
+        else:
+            # seek to indicated starting offset
+            if track_offset > 0:
+                seeked_offset = reader.seek(track_offset)
+            else:
+                seeked_offset = reader.seek(0)
+
+            track_data = audiotools.PCMReaderWindow(
+                reader,
+                track_offset - seeked_offset,
+                PREVIOUS_TRACK_FRAMES + track_length + NEXT_TRACK_FRAMES)
+
+        # with AccurateRip calculated during extraction
+        accuraterip = AccurateRipReader(
+            track_data,
+            track_length,
+            track_number == min(track_offsets.keys()),
+            track_number == max(track_offsets.keys()),
+            timer)
+
+        track_pcm = audiotools.PCMReaderProgress(
+            audiotools.PCMReaderWindow(
+                accuraterip,
+                PREVIOUS_TRACK_FRAMES,
+                track_length,
+                forward_close=False),
+            track_length,
+            progress.update)
+
+        # hand the track's PCM data to an encoder per format, and ReplayGain, as it's read
+        journal.started(track_number, filenames)
+        inputs = []
+        track_encodings = []
+        for (output_class,
+             output_filename,
+             output_quality,
+             output_metadata) in [tracks[index] for tracks in output_tracks]:
+            encoder_input, track = encoders.encode(track_pcm,
+                                                   output_class,
+                                                   str(output_filename),
+                                                   output_quality,
+                                                   track_length,
+                                                   output_metadata)
+            inputs.append(encoder_input)
+            track_encodings.append(track)
+            if replay_gain is None:
+                # nothing else needs doing to it, so it can go as soon as it's encoded
+                sink.store_when_done(track, str(output_filename))
+        if replay_gain is not None:
+            inputs.append(replay_gain.analyze(track_pcm))
+        if dedup_index is not None and track_number not in probes:
+            # the index needs the probe, but it was never worth reading on its own
+            prober = dedup.ProbeDigest(*dedup.probe_range(track_length, probe_frames))
+            inputs.append(prober)
+        else:
+            prober = None
+        outputs = Tee(*inputs)
+        try:
+            audiotools.transfer_data(track_pcm.read, outputs.put)
+        except Exception:
+            # the drive gave up part way through, so everything waiting on the rest of the track
+            # is told there isn't any more, or its threads and processes would wait forever
+            outputs.finish()
+            encoders.shutdown()
+            if replay_gain is not None:
+                replay_gain.shutdown()
+            sink.shutdown()
+            raise
+        outputs.finish()
+        track_pcm.close()
+        if prober is not None:
+            probes[track_number] = prober.hexdigest()
+        encoding.append(track_encodings)
+
+        # since the inner PCMReaderWindow only outputs part
+        # of the accuraterip reader, we need to ensure
+        # anything left over in accuraterip gets processed also
+        audiotools.transfer_data(accuraterip.read, lambda f: None)
+
+        rip_log[track_number] = reader.log()
+        tasks.metrics.track(device, rip_log[track_number])
+        recorder.flush()
+        accuraterip_log_v1[track_number] = accuraterip.checksums_v1()
+        accuraterip_log_v2[track_number] = accuraterip.checksums_v2()
+        track_seconds[track_number] = timer.seconds('read') - read_seconds
+        track_speeds[track_number] = speed_profile[-1][1] if speed_profile else speed
+        unjournaled.append((track_number, filenames, track_encodings))
+        journal_finished()
+
+    reporter.status('Finishing encoding')
+    try:
+        encoded = [[track.result() for track in tracks] for tracks in encoding]
+    except audiotools.EncodingError as err:
+        sink.shutdown()
+        self.update_state(state='FAILURE', meta={'error': str(err)})
+        raise Ignore()
+    finally:
+        encoders.shutdown()
+        journal_finished()
+
+    # tag the whole album with ReplayGain in one go, once it's known
+    if replay_gain is not None:
+        reporter.status('Adding ReplayGain')
+        gains = replay_gain.gains()
+        for tracks, gain in zip(encoded, gains):
+            for track in tracks:
+                if track.supports_replay_gain():
+                    with timer.time('tag'):
+                        track.set_replay_gain(gain)
+        # the tracks were only just finished, so none of them have been stored yet
+        for tracks in output_tracks:
+            for output_track in tracks:
+                sink.store(str(output_track[1]))
+
+    if config.flag(app, 'ripper', 'accuraterip_verify', True):
+        reporter.status('Checking AccurateRip')
+        with timer.time('verify'):
+            submissions = make_mirror(app).lookup(accuraterip_ids)
+        verified = {track_number: accuraterip_confidence(submissions, track_number - 1,
+                                                         accuraterip_log_v1[track_number],
+                                                         accuraterip_log_v2[track_number][0],
+                                                         PREVIOUS_TRACK_FRAMES)
+                    for track_number in tracks_to_rip if track_number > 0}
+    else:
+        verified = None
+
+    reporter.status('Storing tracks')
+    try:
+        sink.finish()
+    except Exception as err:
+        self.update_state(state='FAILURE', meta={'error': str(err)})
+        raise Ignore()
+
+    journal.finish()
+    recorder.flush()
+    tasks.metrics.disc(device)
+    make_rip_log(app).record(
+        {'disc': disc_key, 'task': self.request.id, 'device': device, 'slot': slot,
+         'album': album, 'artist': artist,
+         'frames': sum(track_lengths[track_number] for track_number in tracks_to_rip),
+         'started': started},
+        [{'track_number': track_number,
+          'frames': track_lengths[track_number],
+          'seconds': track_seconds.get(track_number),
+          'speed': track_speeds.get(track_number),
+          'reused': track_number not in track_seconds,
+          'log': rip_log[track_number],
+          'accuraterip_v1': accuraterip_log_v1[track_number][PREVIOUS_TRACK_FRAMES],
+          'accuraterip_v2': accuraterip_log_v2[track_number][0],
+          'verified': verified.get(track_number) if verified is not None else None}
+         for track_number in tracks_to_rip],
+        timer.report())
+
+    return {'status': 'done',
+            'album': album,
+            'artist': artist,
+            'tracks': len(tracks_to_rip),
+            'frames': sum(track_lengths[track_number] for track_number in tracks_to_rip),
+            'stages': timer.report(),
+            'speed_profile': speed_profile,
+            'accuraterip': verified}
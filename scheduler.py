@@ -0,0 +1,180 @@
+"""Decides which disc gets ripped next, and works out when each one should be done"""
+import json
+import time
+import uuid
+import config
+
+
+# a job's score is its estimated seconds, less this for every point of priority, so priority
+# always wins and the shortest job goes first among equals. Jobs with the same score go in the
+# order they were queued, since each one's member in the sorted set starts with its sequence
+PRIORITY_STEP = 10 ** 7
+
+
+class Estimator(object):
+    """Predicts how many seconds a rip will take from how long the disc is and how fast each
+    drive has really read in the past (from RipLog.rates), falling back on rate frames a
+    second and overhead seconds besides reading for drives with no history, and on frames for
+    discs whose TOC hasn't been read yet. load is the seconds the changer takes to get a disc
+    into a drive and back"""
+
+    def __init__(self, rates, rate, overhead, frames, load):
+        self.rates = rates
+        self.rate = rate
+        self.overhead = overhead
+        self.frames = frames
+        self.load = load
+
+    def drive(self, device=None):
+        """Returns the (rate, overhead) to expect from device, or from the average drive"""
+        known = [self.rates[device]] if device in self.rates else list(self.rates.values())
+        rates = [history['rate'] for history in known if history['rate']]
+        overheads = [history['overhead'] for history in known if history['overhead'] is not None]
+        return (sum(rates) / len(rates) if rates else self.rate,
+                sum(overheads) / len(overheads) if overheads else self.overhead)
+
+    def estimate(self, frames, device=None):
+        rate, overhead = self.drive(device)
+        if frames is None:
+            frames = self.frames
+        return frames / rate + overhead + self.load
+
+
+class Scheduler(object):
+    """Holds slot rips back in a redis sorted set, ordered by priority and then by how long
+    they're expected to take, and only hands one to celery when a drive is free for it.
+
+    dispatch() has to be called whenever a job is added or a drive frees up."""
+
+    def __init__(self, redis, drives, prefix="ripper:schedule"):
+        self.redis = redis
+        self.drives = drives
+        self.prefix = prefix
+
+    def key(self, name):
+        return "%s:%s" % (self.prefix, name)
+
+    def remember_frames(self, slot, frames):
+        """Notes how long the disc in a slot is, once its TOC has been read"""
+        self.redis.hset(self.key("frames"), slot, frames)
+
+    def forget_frames(self, slot):
+        self.redis.hdel(self.key("frames"), slot)
+
+    def frames(self, slot):
+        frames = self.redis.hget(self.key("frames"), slot)
+        return None if frames is None else int(frames)
+
+    def add(self, slot, priority, estimator):
+        """Queues up a rip of slot, returning its job id, which is also its task id"""
+        job = {'id': str(uuid.uuid4()),
+               'slot': slot,
+               'priority': priority,
+               'frames': self.frames(slot),
+               'queued': time.time()}
+        job['estimate'] = estimator.estimate(job['frames'])
+        job['member'] = "%015d:%s" % (self.redis.incr(self.key("sequence")), job['id'])
+        pipe = self.redis.pipeline()
+        pipe.hset(self.key("jobs"), job['id'], json.dumps(job))
+        pipe.zadd(self.key("queue"), job['estimate'] - priority * PRIORITY_STEP, job['member'])
+        pipe.execute()
+        return job['id']
+
+    def job(self, job_id):
+        job = self.redis.hget(self.key("jobs"), job_id)
+        return None if job is None else json.loads(job)
+
+    def queued(self, job_id):
+        job = self.job(job_id)
+        return job is not None and self.redis.zscore(self.key("queue"), job['member']) is not None
+
+    def pop(self):
+        """Takes the best job off the queue, or returns None if there isn't one"""
+        while True:
+            best = self.redis.zrange(self.key("queue"), 0, 0)
+            if not best:
+                return None
+            self.redis.zrem(self.key("queue"), best[0])
+            job = self.job(best[0].split(":", 1)[1])
+            if job is not None:
+                return job
+
+    def dispatch(self, send):
+        """Hands the best queued jobs to send, one for each drive with nothing to do, after
+        assigning each its drive"""
+        with self.redis.lock(self.key("lock"), timeout=30):
+            idle = [drive['drive'] for drive in self.drives.status()
+                    if drive['busy'] is None and drive['queued'] == 0]
+            for drive in idle:
+                job = self.pop()
+                if job is None:
+                    return
+                job['drive'] = drive
+                job['device'] = self.drives.device(drive)
+                job['dispatched'] = time.time()
+                self.drives.enqueue(drive)
+                self.redis.hset(self.key("running"), job['id'], json.dumps(job))
+                send(job)
+
+    def finished(self, job_id):
+        """Forgets a job that's done, whichever way it went"""
+        job = self.job(job_id)
+        pipe = self.redis.pipeline()
+        if job is not None:
+            pipe.zrem(self.key("queue"), job['member'])
+        pipe.hdel(self.key("running"), job_id)
+        pipe.hdel(self.key("jobs"), job_id)
+        pipe.execute()
+
+    def etas(self):
+        """Returns every running and queued job with when it's expected to start and finish,
+        and when the whole queue should be done.
+
+        Each drive is assumed to take the next job in the queue as soon as its current one's
+        expected to be done"""
+        now = time.time()
+        free_at = {drive: now for drive in range(len(self.drives.devices))}
+        running = [json.loads(job) for job in self.redis.hvals(self.key("running"))]
+        for job in running:
+            job['start'] = job['dispatched']
+            job['eta'] = max(now, job['dispatched'] + job['estimate'])
+            free_at[job['drive']] = max(free_at.get(job['drive'], now), job['eta'])
+
+        queued = []
+        order = self.redis.zrange(self.key("queue"), 0, -1)
+        if order:
+            jobs = self.redis.hmget(self.key("jobs"),
+                                    [member.split(":", 1)[1] for member in order])
+            for job in jobs:
+                if job is None:
+                    continue
+                job = json.loads(job)
+                drive = min(free_at, key=lambda drive: (free_at[drive], drive))
+                job['start'] = free_at[drive]
+                job['eta'] = job['start'] + job['estimate']
+                free_at[drive] = job['eta']
+                queued.append(job)
+
+        everything = running + queued
+        return {'running': sorted(running, key=lambda job: job['eta']),
+                'queued': queued,
+                'eta': max(job['eta'] for job in everything) if everything else None}
+
+    def eta(self, job_id):
+        """Returns a single job from etas(), or None if it's not running or queued"""
+        etas = self.etas()
+        for job in etas['running'] + etas['queued']:
+            if job['id'] == job_id:
+                return job
+        return None
+
+
+def make_estimator(app, rip_log):
+    """Builds an Estimator from the rip log's recent history and the ripper.estimate_*
+    settings"""
+    days = config.option(app, 'ripper', 'estimate_history_days', 30, float)
+    return Estimator(rip_log.rates(time.time() - days * 24 * 60 * 60),
+                     config.option(app, 'ripper', 'estimate_speed', 8, float) * 44100,
+                     config.option(app, 'ripper', 'estimate_overhead', 60, float),
+                     config.option(app, 'ripper', 'estimate_minutes', 50, float) * 60 * 44100,
+                     config.option(app, 'ripper', 'estimate_load_seconds', 20, float))
@@ -0,0 +1,135 @@
+"""Secure ripping: re-reads whatever the drive had trouble with, and nothing else"""
+from collections import OrderedDict
+import hashlib
+from audiotools import pcm
+
+
+SECTOR_FRAMES = 588
+
+# the counters in CDDAReader.log() that mean a read can't be trusted
+ERROR_COUNTERS = ('readerr', 'skip', 'scratch', 'repair', 'fixup_dropped', 'fixup_duped')
+
+
+def has_errors(log):
+    return any(log.get(counter, 0) > 0 for counter in ERROR_COUNTERS)
+
+
+def digest(framelist):
+    return hashlib.sha1(framelist.to_bytes(False, True)).digest()
+
+
+class SecureReader(object):
+    """Wraps a CDDAReader, reading the disc in blocks of whole sectors.
+
+    Whenever the drive's log shows trouble during a block, that block alone is read again until
+    two re-reads with clean logs agree. Before each re-read, flush_sectors are read from
+    flush_distance sectors away, so the drive has to go back to the disc rather than hand back
+    what's in its cache. Recent good blocks are cached here too, so seeking back over them
+    (like each track does for the previous track's AccurateRip window) doesn't read them
+    twice."""
+
+    def __init__(self, cddareader, block_sectors=75, max_rereads=16, cache_blocks=2,
+                 flush_distance=10000, flush_sectors=75):
+        self.cddareader = cddareader
+        self.sample_rate = cddareader.sample_rate
+        self.channels = cddareader.channels
+        self.channel_mask = cddareader.channel_mask
+        self.bits_per_sample = cddareader.bits_per_sample
+        self.block_frames = block_sectors * SECTOR_FRAMES
+        self.max_rereads = max_rereads
+        self.cache_blocks = cache_blocks
+        self.flush_distance = flush_distance * SECTOR_FRAMES
+        self.flush_frames = flush_sectors * SECTOR_FRAMES
+        self.total_frames = ((cddareader.last_sector - cddareader.first_sector + 1) *
+                             SECTOR_FRAMES)
+        self.cache = OrderedDict()
+        self.buffer = pcm.empty_framelist(self.channels, self.bits_per_sample)
+        self.position = 0
+        self.drive_position = 0
+        self.reset_log()
+
+    def reset_log(self):
+        self.totals = {'rereads': 0, 'unresolved': 0}
+
+    def log(self):
+        """Returns the drive's counters summed over every read since reset_log, plus how many
+        blocks were re-read and how many of those never got two matching reads"""
+        return dict(self.totals)
+
+    def add_log(self, log):
+        for counter, value in log.items():
+            self.totals[counter] = self.totals.get(counter, 0) + value
+
+    def seek(self, pcm_frames):
+        for start, block in self.cache.items():
+            if start <= pcm_frames < start + block.frames:
+                (skipped, self.buffer) = block.split(pcm_frames - start)
+                self.position = start + block.frames
+                return pcm_frames
+        self.position = self.drive_position = self.cddareader.seek(pcm_frames)
+        self.buffer = pcm.empty_framelist(self.channels, self.bits_per_sample)
+        return self.position
+
+    def read(self, pcm_frames):
+        if self.buffer.frames == 0:
+            self.buffer = self.read_block()
+        if self.buffer.frames <= pcm_frames:
+            framelist = self.buffer
+            self.buffer = pcm.empty_framelist(self.channels, self.bits_per_sample)
+            return framelist
+        (framelist, self.buffer) = self.buffer.split(pcm_frames)
+        return framelist
+
+    def read_raw(self, start, pcm_frames):
+        """Reads straight from the drive, returning the frames and the drive's log for them"""
+        if self.drive_position != start:
+            self.drive_position = self.cddareader.seek(start)
+        self.cddareader.reset_log()
+        framelist = self.cddareader.read(pcm_frames)
+        self.drive_position = start + framelist.frames
+        log = self.cddareader.log()
+        self.add_log(log)
+        return framelist, log
+
+    def flush(self, start):
+        """Reads somewhere else on the disc, to push the block at start out of the drive's
+        cache. What the drive says about it doesn't count"""
+        elsewhere = start + self.flush_distance
+        if elsewhere + self.flush_frames > self.total_frames:
+            elsewhere = max(start - self.flush_distance, 0)
+        self.drive_position = self.cddareader.seek(elsewhere)
+        self.drive_position += self.cddareader.read(self.flush_frames).frames
+        self.cddareader.reset_log()
+
+    def read_block(self):
+        start = self.position
+        if start in self.cache:
+            block = self.cache[start]
+        else:
+            block, log = self.read_raw(start, self.block_frames)
+            if block.frames > 0 and has_errors(log):
+                block = self.reread(start, block)
+            self.cache[start] = block
+            while len(self.cache) > self.cache_blocks:
+                self.cache.popitem(last=False)
+        self.position = start + block.frames
+        return block
+
+    def reread(self, start, block):
+        """Reads a suspect block again until two clean reads in a row agree. If they never do,
+        the block counts as unresolved, and the last clean read is kept if there was one"""
+        frames = block.frames
+        previous = clean = None
+        for attempt in range(self.max_rereads):
+            self.totals['rereads'] += 1
+            self.flush(start)
+            block, log = self.read_raw(start, frames)
+            if has_errors(log):
+                previous = None
+                continue
+            current = digest(block)
+            if current == previous:
+                return block
+            (previous, clean) = (current, block)
+        self.totals['unresolved'] += 1
+        return block if clean is None else clean
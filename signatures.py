@@ -0,0 +1,29 @@
+"""The worker's tasks by name, so the webapp can queue them and check on them without importing
+tasks and everything that comes with it"""
+from celerymaker import make_celery
+
+
+class TaskSignature(object):
+    """Stands in for one of the tasks in tasks.py, as far as sending it and getting its results
+    go"""
+
+    def __init__(self, celery, name):
+        self.celery = celery
+        self.name = name
+
+    def apply_async(self, args=None, kwargs=None, task_id=None):
+        return self.celery.send_task(self.name, args=args, kwargs=kwargs, task_id=task_id)
+
+    def AsyncResult(self, task_id):
+        return self.celery.AsyncResult(task_id)
+
+
+class TaskSignatures(object):
+    """All of the tasks in tasks.py"""
+
+    def __init__(self, app):
+        self.celery = make_celery(app)
+        self.rip_disk = TaskSignature(self.celery, 'tasks.rip_disk')
+        self.prewarm_metadata = TaskSignature(self.celery, 'tasks.prewarm_metadata')
+        self.batch_rip = TaskSignature(self.celery, 'tasks.batch_rip')
+        self.mtx_command = TaskSignature(self.celery, 'tasks.mtx_command')
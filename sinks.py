@@ -0,0 +1,108 @@
+"""Where finished tracks end up"""
+from concurrent.futures import ThreadPoolExecutor
+import os
+import time
+import config
+
+
+class DirectorySink(object):
+    """Tracks are encoded straight into the output directory, which can just as well be an NFS
+    mount, so once a track's encoded there's nothing left to do"""
+
+    # the files stay where they were encoded, so the dedup index can point at them
+    keeps_files = True
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def store(self, filename):
+        pass
+
+    def store_when_done(self, track, filename):
+        pass
+
+    def finish(self):
+        pass
+
+    def shutdown(self):
+        pass
+
+
+class S3Sink(object):
+    """Tracks are encoded into the output directory as a spool, and each one's uploaded to an
+    S3 compatible store as soon as it's final, in parts, while the rest of the disc is ripping.
+    The key is the track's path under the spool directory, after prefix.
+
+    The spool copies stay until the whole disc is uploaded, so a rip that dies part way through
+    can still pick up where it left off."""
+
+    keeps_files = False
+
+    def __init__(self, directory, bucket, prefix="", endpoint_url=None, part_size=8 * 1024 * 1024,
+                 workers=4, timer=None):
+        # only needed by whoever uploads
+        import boto3
+        from boto3.s3.transfer import TransferConfig
+        self.directory = directory
+        self.bucket = bucket
+        self.prefix = prefix
+        self.client = boto3.client('s3', endpoint_url=endpoint_url)
+        self.transfer_config = TransferConfig(multipart_threshold=part_size,
+                                              multipart_chunksize=part_size,
+                                              max_concurrency=workers)
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.timer = timer
+        self.uploads = {}
+
+    def key(self, filename):
+        relative = os.path.relpath(os.path.abspath(filename), os.path.abspath(self.directory))
+        return self.prefix + relative.replace(os.sep, "/")
+
+    def upload(self, filename):
+        started = time.time()
+        self.client.upload_file(filename, self.bucket, self.key(filename),
+                                Config=self.transfer_config)
+        if self.timer is not None:
+            self.timer.add('upload', time.time() - started)
+
+    def store(self, filename):
+        """Starts uploading a finished track"""
+        if filename not in self.uploads:
+            self.uploads[filename] = self.executor.submit(self.upload, filename)
+
+    def store_when_done(self, track, filename):
+        """Uploads filename once track, the future encoding it, succeeds"""
+        def done(track):
+            if not track.cancelled() and track.exception() is None:
+                self.store(filename)
+        track.add_done_callback(done)
+
+    def finish(self):
+        """Waits for every upload, raising the first error, then clears out the spool"""
+        try:
+            for upload in list(self.uploads.values()):
+                upload.result()
+        finally:
+            self.executor.shutdown(wait=True)
+        for filename in self.uploads:
+            os.remove(filename)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+
+
+def make_sink(app, timer=None):
+    """Builds the sink named by ripper.sink: "directory" (the default) or "s3" """
+    sink = config.option(app, 'ripper', 'sink', 'directory')
+    directory = app.config['ripper']['output_directory']
+    if sink == 'directory':
+        return DirectorySink(directory)
+    if sink == 's3':
+        return S3Sink(directory,
+                      app.config['ripper']['s3_bucket'],
+                      config.option(app, 'ripper', 's3_prefix', ''),
+                      config.option(app, 'ripper', 's3_endpoint_url'),
+                      config.option(app, 'ripper', 's3_part_size', 8, int) * 1024 * 1024,
+                      config.option(app, 'ripper', 'uploaders', 4, int),
+                      timer)
+    raise ValueError("Unknown sink %s" % sink)
@@ -0,0 +1,114 @@
+"""Picks the drive's read speed as it goes, based on how the disc is reading"""
+import time
+from securerip import ERROR_COUNTERS
+
+
+class SpeedController(object):
+    """Wraps a CDDAReader, starting it at the fastest of speeds and watching each block of
+    block_frames it reads.
+
+    A block with errors in the drive's log steps the speed down, and so does one that came in
+    slower than the next speed down really did read within nearby_blocks of it. Drives are
+    CAV at their higher speeds, so their nominal speeds mean little until the outer edge of the
+    disc. clean_blocks clean blocks in a row step it back up. The first block after a change or
+    a seek is only judged on its errors, since the drive is still spinning up or down. Every
+    change is recorded in profile.
+
+    It keeps its own totals of the drive's log, so the drive's log can be reset every read
+    without losing anything."""
+
+    def __init__(self, cddareader, speeds, block_frames, clean_blocks=3, nearby_blocks=10):
+        self.cddareader = cddareader
+        self.sample_rate = cddareader.sample_rate
+        self.channels = cddareader.channels
+        self.channel_mask = cddareader.channel_mask
+        self.bits_per_sample = cddareader.bits_per_sample
+        self.speeds = sorted(speeds, reverse=True)
+        self.block_frames = block_frames
+        self.clean_blocks = clean_blocks
+        self.nearby = nearby_blocks * block_frames
+        # (position, rate) of every settled, clean block, for each level
+        self.rates = [[] for speed in self.speeds]
+        self.position = 0
+        self.profile = []
+        self.clean = 0
+        self.reset_log()
+        self.set_level(0)
+
+    def __getattr__(self, attr):
+        return getattr(self.cddareader, attr)
+
+    def speed(self):
+        return self.speeds[self.level]
+
+    def set_level(self, level):
+        self.level = level
+        self.cddareader.set_speed(self.speed())
+        self.profile.append([self.position, self.speed()])
+        self.settled = False
+        self.start_block()
+
+    def start_block(self):
+        self.block_read = 0
+        self.block_seconds = 0.0
+        self.block_errors = 0
+
+    def reset_log(self):
+        self.totals = {}
+
+    def log(self):
+        return dict(self.totals)
+
+    def seek(self, pcm_frames):
+        self.position = self.cddareader.seek(pcm_frames)
+        self.settled = False
+        self.start_block()
+        return self.position
+
+    def read(self, pcm_frames):
+        self.cddareader.reset_log()
+        started = time.time()
+        framelist = self.cddareader.read(pcm_frames)
+        self.block_seconds += time.time() - started
+        for counter, value in self.cddareader.log().items():
+            self.totals[counter] = self.totals.get(counter, 0) + value
+            if counter in ERROR_COUNTERS:
+                self.block_errors += value
+        self.position += framelist.frames
+        self.block_read += framelist.frames
+        if self.block_read >= self.block_frames:
+            self.judge_block()
+        return framelist
+
+    def judge_block(self):
+        # realtime is 1x
+        rate = self.block_read / self.sample_rate / self.block_seconds \
+            if self.block_seconds > 0 else None
+        slower = self.level + 1 < len(self.speeds)
+        if self.settled and rate is not None and self.block_errors == 0:
+            self.rates[self.level].append((self.position, rate))
+        slower_rate = self.rate_near(self.level + 1) if slower else None
+        struggling = (self.settled and rate is not None and slower_rate is not None and
+                      rate < slower_rate)
+        if self.block_errors > 0 or struggling:
+            self.clean = 0
+            if slower:
+                self.set_level(self.level + 1)
+                return
+        else:
+            self.clean += 1
+            if self.clean >= self.clean_blocks and self.level > 0:
+                self.clean = 0
+                self.set_level(self.level - 1)
+                return
+        self.settled = True
+        self.start_block()
+
+    def rate_near(self, level):
+        """How fast level read the closest block to here, if it read one nearby"""
+        nearby = [(abs(position - self.position), rate) for position, rate in self.rates[level]
+                  if abs(position - self.position) <= self.nearby]
+        return min(nearby)[1] if nearby else None
+
+    def close(self):
+        self.cddareader.close()
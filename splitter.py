@@ -0,0 +1,91 @@
+"""Reads the whole disc in one pass and splits it into tracks in memory"""
+from collections import deque
+from audiotools import pcm
+
+
+class DiscSplitter(object):
+    """Reads a CDDAReader front to back in large blocks and hands out windows onto it.
+
+    Each track's window overlaps the next one's by overlap frames for AccurateRip, so rather
+    than seeking back for them, the blocks are kept until every window that needs them is done.
+    Windows have to be opened in disc order; asking for one further on than what's been read
+    seeks forward."""
+
+    def __init__(self, reader, block_frames, overlap):
+        self.reader = reader
+        self.sample_rate = reader.sample_rate
+        self.channels = reader.channels
+        self.channel_mask = reader.channel_mask
+        self.bits_per_sample = reader.bits_per_sample
+        self.block_frames = block_frames
+        self.overlap = overlap
+        self.blocks = deque()
+        self.position = None
+
+    def window(self, start, length):
+        """Returns a PCMReader for length frames from start, padded with silence past the ends
+        of the disc"""
+        return SplitterWindow(self, start, length)
+
+    def silence(self, pcm_frames):
+        return pcm.from_list([0] * pcm_frames * self.channels, self.channels,
+                             self.bits_per_sample, True)
+
+    def read_at(self, start, pcm_frames):
+        """Returns up to pcm_frames frames from start, stopping early at the end of a block.
+        Returns an empty FrameList at the end of the disc"""
+        if start < 0:
+            return self.silence(min(pcm_frames, -start))
+
+        first = self.blocks[0][0] if self.blocks else self.position
+        if self.position is None or start < first or start > self.position:
+            self.blocks.clear()
+            self.position = self.reader.seek(start)
+        while self.position <= start:
+            block = self.reader.read(self.block_frames)
+            if block.frames == 0:
+                return pcm.empty_framelist(self.channels, self.bits_per_sample)
+            self.blocks.append((self.position, block))
+            self.position += block.frames
+
+        for block_start, block in self.blocks:
+            if block_start <= start < block_start + block.frames:
+                break
+        if start > block_start:
+            (skipped, block) = block.split(start - block_start)
+        if block.frames > pcm_frames:
+            (block, rest) = block.split(pcm_frames)
+        return block
+
+    def release(self, position):
+        """Forgets the blocks that end before position"""
+        while self.blocks and self.blocks[0][0] + self.blocks[0][1].frames <= position:
+            self.blocks.popleft()
+
+
+class SplitterWindow(object):
+    """One track's window onto a DiscSplitter"""
+
+    def __init__(self, splitter, start, length):
+        self.splitter = splitter
+        self.sample_rate = splitter.sample_rate
+        self.channels = splitter.channels
+        self.channel_mask = splitter.channel_mask
+        self.bits_per_sample = splitter.bits_per_sample
+        self.position = start
+        self.end = start + length
+
+    def read(self, pcm_frames):
+        pcm_frames = min(pcm_frames, self.end - self.position)
+        if pcm_frames <= 0:
+            return pcm.empty_framelist(self.channels, self.bits_per_sample)
+        framelist = self.splitter.read_at(self.position, pcm_frames)
+        if framelist.frames == 0:
+            framelist = self.splitter.silence(pcm_frames)
+        self.position += framelist.frames
+        # the next track's window starts at most overlap frames before this one ends
+        self.splitter.release(min(self.position, self.end - self.splitter.overlap))
+        return framelist
+
+    def close(self):
+        pass
@@ -0,0 +1,73 @@
+"""Times each stage of a rip"""
+from contextlib import contextmanager
+import threading
+import time
+
+
+class StageTimer(object):
+    """Adds up the time spent, frames handled and calls made in each stage of a rip.
+
+    Stages run on different threads, so everything goes through a lock."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stages = {}
+
+    def add(self, stage, seconds, frames=0, calls=1):
+        with self.lock:
+            totals = self.stages.setdefault(stage, {'seconds': 0.0, 'frames': 0, 'calls': 0})
+            totals['seconds'] += seconds
+            totals['frames'] += frames
+            totals['calls'] += calls
+
+    @contextmanager
+    def time(self, stage, frames=0):
+        started = time.time()
+        try:
+            yield
+        finally:
+            self.add(stage, time.time() - started, frames)
+
+    def seconds(self, stage):
+        """Returns the time spent in a stage so far"""
+        with self.lock:
+            return self.stages.get(stage, {}).get('seconds', 0.0)
+
+    def report(self):
+        """Returns the totals for every stage, with a frames per second rate for each"""
+        with self.lock:
+            report = {}
+            for stage, totals in self.stages.items():
+                report[stage] = dict(totals)
+                if totals['seconds'] > 0:
+                    report[stage]['rate'] = totals['frames'] / totals['seconds']
+                else:
+                    report[stage]['rate'] = None
+            return report
+
+
+class TimedReader(object):
+    """Wraps a PCMReader, timing every read as the given stage.
+
+    Anything else, like a CDDAReader's seek or log, is passed straight through."""
+
+    def __init__(self, pcmreader, timer, stage):
+        self.pcmreader = pcmreader
+        self.timer = timer
+        self.stage = stage
+        self.sample_rate = pcmreader.sample_rate
+        self.channels = pcmreader.channels
+        self.channel_mask = pcmreader.channel_mask
+        self.bits_per_sample = pcmreader.bits_per_sample
+
+    def __getattr__(self, attr):
+        return getattr(self.pcmreader, attr)
+
+    def read(self, pcm_frames):
+        started = time.time()
+        framelist = self.pcmreader.read(pcm_frames)
+        self.timer.add(self.stage, time.time() - started, framelist.frames)
+        return framelist
+
+    def close(self):
+        self.pcmreader.close()
@@ -66,12 +66,29 @@ function showChangerStatus(result) {
   }
 }
 
+function isRunning(result) {
+  return result.state == "PENDING" || result.state == "PROGRESS" || result.state == "RETRY";
+}
+
+function listenFor(url, callback) {
+  var source = new EventSource(url);
+  source.onmessage = function(e) {
+    var result = JSON.parse(e.data);
+    if(!isRunning(result)) {
+      source.close();
+      callback(result);
+    }
+  };
+}
+
 function waitFor(url, callback) {
   fetch(url).then(function(response) {
     response.json().then(function(result) {
-      if(result.hasOwnProperty('updates')) {
+      if(result.hasOwnProperty('events') && window.EventSource) {
+        listenFor(result.events, callback);
+      } else if(result.hasOwnProperty('updates')) {
         waitFor(result.updates, callback);
-      } else if(result.state == "PENDING" || result.state == "PROGRESS") {
+      } else if(isRunning(result)) {
         setTimeout(waitFor, 500, url, callback);
       } else {
         callback(result);
@@ -1,289 +1,230 @@
 """Various celery tasks"""
 import fakemtx as mtx
-import audiotools
-from audiotools.ui import process_output_options
-from audiotools import accuraterip
-from audiotools.cdio import CDDAReader
 from celerymaker import make_celery
+import discid
+from metacache import make_metadata_cache
+from drives import make_drive_pool
+from redismaker import make_redis
+from inventory import Inventory
+from planner import make_planner
+from metrics import Metrics
+from accuraterip import make_mirror
+from riplog import make_rip_log
+from scheduler import Scheduler, make_estimator
 from celery.exceptions import Ignore
 from flask import Flask
 import config
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 
-PREVIOUS_TRACK_FRAMES = (5880 // 2)
-NEXT_TRACK_FRAMES = (5880 // 2)
-
 app = Flask(__name__)
 config.configure(app)
-msg = audiotools.SilentMessenger()
-
-
-celery = make_celery(app)
-changer = mtx.Changer(app.config['ripper']['changer'])
-
-
-celery.conf.update(CELERY_ROUTES={
-    'tasks.rip_disk': {'queue': 'cdrom'},
-    'tasks.mtx_command': {'queue': 'changer'}
-    })
-
-
-class AccurateRipReader(object):
-    def __init__(self, pcmreader, total_pcm_frames, is_first, is_last):
-        """pcmreader is a PCMReader object to wrap around
-        total_pcm_frames is the length of pcmreader,
-        not including previous and next track frames
-        is_first and is_last indicate the track's position in the stream"""
-
-        self.pcmreader = pcmreader
-
-        self.checksummer = accuraterip.Checksum(
-            total_pcm_frames=total_pcm_frames,
-            sample_rate=pcmreader.sample_rate,
-            is_first=is_first,
-            is_last=is_last,
-            pcm_frame_range=PREVIOUS_TRACK_FRAMES + 1 + NEXT_TRACK_FRAMES,
-            accurateripv2_offset=PREVIOUS_TRACK_FRAMES)
-
-        self.sample_rate = pcmreader.sample_rate
-        self.channels = pcmreader.channels
-        self.channel_mask = pcmreader.channel_mask
-        self.bits_per_sample = pcmreader.bits_per_sample
-
-    def read(self, pcm_frames):
-        frame = self.pcmreader.read(pcm_frames)
-        self.checksummer.update(frame)
-        return frame
 
-    def close(self):
-        self.pcmreader.close()
 
-    def checksums_v1(self):
-        return self.checksummer.checksums_v1()
-
-    def checksums_v2(self):
-        return [self.checksummer.checksum_v2()]
-
-
-class CeleryProgressDisplay(audiotools.ProgressDisplay):
-    """A ProgressDisplay class to send status updates via celery's update_state"""
-    def __init__(self, messenger, metadata, celery_task):
-        audiotools.ProgressDisplay.__init__(self, messenger)
-        self.metadata = metadata
-        self.celery_task = celery_task
-
-    def update(self, progress):
-        """updates the celery state with new progress value"""
-        metadata = self.metadata
-        metadata['progress'] = progress.numerator/progress.denominator
-        self.celery_task.update_state(state='PROGRESS', meta=metadata)
-
-
-def jsonify_metadata(metadatas):
-    out = []
-    for metadata in metadatas:
-        out.append({attr: field for attr, field in metadata.filled_fields()})
-    return out
-
-
-def merge_metadatas(metadatas):
-    if len(metadatas) == 0:
-        return audiotools.MetaData()
-    elif len(metadatas) == 1:
-        return metadatas[0]
-    else:
-        merged = metadatas[0]
-        for to_merge in metadatas[1:]:
-            merged = merged.intersection(to_merge)
-        return merged
-
-
-@celery.task(bind=True)
-def rip_disk(self):
-    """Most of this is just copied from cdda2track, a part of python-audio-tools"""
-    try:
-        cddareader = CDDAReader(app.config['ripper']['cdrom'], True)
-        track_offsets = cddareader.track_offsets
-        track_lengths = cddareader.track_lengths
-    except (IOError, ValueError, OSError) as err:
-        self.update_state(state='FAILURE', meta={'error': str(err)})
-        raise Ignore()
+def open_changer(device, inventory, metrics):
+    """Opens the changer at device, or a simulated one for "synthetic:..." (see benchmark.py)"""
+    if device.startswith("synthetic:"):
+        import benchmark
+        return mtx.Changer(device, inventory=inventory, metrics=metrics,
+                           mtx=benchmark.SimulatedMtx(device[len("synthetic:"):]))
+    return mtx.Changer(device, inventory=inventory, metrics=metrics)
 
-    if "offset" in app.config['ripper']:
-        read_offset = app.config['ripper']['offset']
-    else:
-        read_offset = 0
-    if "speed" in app.config['ripper']:
-        cddareader.set_speed(app.config['ripper']['speed'])
 
-    pre_gap_length = cddareader.track_offsets[1]
-    if pre_gap_length > 0:
-        with audiotools.BufferedPCMReader(audiotools.PCMReaderWindow(cddareader,
-                                                                     read_offset,
-                                                                     pre_gap_length,
-                                                                     forward_close=False)) as r:
-            preserve_pre_gap = set(r.read(pre_gap_length)) != {0}
-            if preserve_pre_gap:
-                track_offsets[0] = 0
-                track_lengths[0] = pre_gap_length
-    else:
-        preserve_pre_gap = False
+def open_cddareader(device):
+    """Opens the drive at device, or a made up disc for "synthetic:..." (see benchmark.py)"""
+    if device.startswith("synthetic:"):
+        import benchmark
+        return benchmark.SyntheticCDDAReader(device[len("synthetic:"):])
+    # cdio is only imported by workers that actually use a drive
+    from audiotools.cdio import CDDAReader
+    return CDDAReader(device, True)
 
-    self.update_state(state='PROGRESS', meta={'current': None,
-                                              'total': None,
-                                              'album': None,
-                                              'artist': None,
-                                              'metadata': [],
-                                              'status': 'Reading metadata'})
-    metadata_choices = audiotools.cddareader_metadata_lookup(cddareader)
 
-    if preserve_pre_gap:
-        # prepend "track 0" track to start of list for each choice
-        for choice in metadata_choices:
-            track_0 = merge_metadatas(choice)
-            track_0.track_number = 0
-            choice.insert(0, track_0)
-
-    album = metadata_choices[0][0].album_name
-    artist = metadata_choices[0][0].artist_name
-    self.update_state(state='PROGRESS', meta={'current': None,
-                                              'total': len(track_offsets),
-                                              'album': album,
-                                              'artist': artist,
-                                              'metadata': jsonify_metadata(metadata_choices[0]),
-                                              'status': 'Got metadata, preparing to rip'})
+celery = make_celery(app)
+redis = make_redis(app)
+metrics = Metrics(redis)
+changer = None
+drives = make_drive_pool(app, redis)
+scheduler = Scheduler(redis, drives)
+metadata_cache = make_metadata_cache(app)
+
+
+def get_changer():
+    """Opens the changer the first time a task needs it"""
+    global changer
+    if changer is None:
+        changer = open_changer(app.config['ripper']['changer'], Inventory(redis), metrics)
+    return changer
+
+
+# waiting for a drive has to go on as long as it takes. Passing max_retries=None to retry()
+# only means "the task's own limit", so it's set here
+@celery.task(bind=True, max_retries=None)
+def rip_disk(self, slot=None, drive=None):
+    """Rips the disc in drive, or if a slot is given, claims a free drive (preferring the one the
+    job was assigned to) and loads the disc from that slot into it first"""
+    if slot is None and drive is None:
+        drive = 0
+    claimed = drives.claim(self.request.id, drive, any_drive=slot is not None)
+    if claimed is None:
+        raise self.retry(countdown=config.option(app, 'ripper', 'drive_retry', 10, int))
+    if drive is not None:
+        drives.dequeue(drive)
+    changer = get_changer()
+    heartbeat = drives.hold(claimed, self.request.id)
 
-    tracks_to_rip = list(sorted(track_offsets.keys()))
     try:
-        output_tracks = list(
-            process_output_options(
-                metadata_choices=[
-                    [c for i, c in
-                     enumerate(choices, 0 if preserve_pre_gap else 1)
-                     if i in tracks_to_rip]
-                    for choices in metadata_choices],
-                input_filenames=[
-                    audiotools.Filename("track{:02d}.cdda.wav".format(i))
-                    for i in tracks_to_rip],
-                output_directory=app.config['ripper']['output_directory'],
-                format_string=None,
-                output_class=audiotools.wav.WaveAudio,
-                quality='',
-                msg=msg,
-                use_default=True))
-    except audiotools.UnsupportedTracknameField as err:
-        self.update_state(state='FAILURE', meta={'error': str(err)})
-        raise Ignore()
-
-    encoded = []
-    rip_log = {}
-    accuraterip_log_v1 = {}
-    accuraterip_log_v2 = {}
-    replay_gain = audiotools.ReplayGainCalculator(cddareader.sample_rate)
-
-    for (track_number,
-         index,
-         (output_class,
-          output_filename,
-          output_quality,
-          output_metadata)) in zip(tracks_to_rip,
-                                   range(1, len(tracks_to_rip) + 1),
-                                   output_tracks):
-        self.update_state(state='PROGRESS', meta={'current': track_number,
-                                                  'total': len(tracks_to_rip),
-                                                  'album': album,
-                                                  'artist': artist,
-                                                  'metadata': jsonify_metadata(metadata_choices[0]),
-                                                  'status': 'Preparing to rip'})
-        cddareader.reset_log()
-        track_offset = (track_offsets[track_number] +
-                        read_offset -
-                        PREVIOUS_TRACK_FRAMES)
-        track_length = track_lengths[track_number]
-
-        # seek to indicated starting offset
-        if track_offset > 0:
-            seeked_offset = cddareader.seek(track_offset)
-        else:
-            seeked_offset = cddareader.seek(0)
-
-        # make leading directories, if necessary
+        if slot is not None:
+            try:
+                drives.load(changer, slot, claimed)
+            except mtx.DriveAlreadyLoaded as err:
+                self.update_state(state='FAILURE', meta={'error': str(err), 'drive': claimed})
+                raise Ignore()
         try:
-            audiotools.make_dirs(str(output_filename))
-        except OSError as err:
-            self.update_state(state='FAILURE', meta={'error': str(err)})
-            raise Ignore()
-
-        # setup individual progress bar per track
-        state = {'current': track_number,
-                 'total': len(tracks_to_rip),
-                 'album': album,
-                 'artist': artist,
-                 'metadata': jsonify_metadata(metadata_choices[0]),
-                 'status': 'Ripping...'}
-        progress = CeleryProgressDisplay(msg, state, self)
-
-        # perform extraction over an AccurateRip window
-        track_data = audiotools.PCMReaderWindow(
-            cddareader,
-            track_offset - seeked_offset,
-            PREVIOUS_TRACK_FRAMES + track_length + NEXT_TRACK_FRAMES)
-
-        # with AccurateRip calculated during extraction
-        accuraterip = AccurateRipReader(
-            track_data,
-            track_length,
-            track_number == min(track_offsets.keys()),
-            track_number == max(track_offsets.keys()))
-
-        try:
-            # encode output file itself
-            track = output_class.from_pcm(
-                str(output_filename),
-                replay_gain.to_pcm(
-                    audiotools.PCMReaderProgress(
-                        audiotools.PCMReaderWindow(
-                            accuraterip,
-                            PREVIOUS_TRACK_FRAMES,
-                            track_length,
-                            forward_close=False),
-                        track_length,
-                        progress.update)),
-                output_quality,
-                total_pcm_frames=track_length)
-            encoded.append(track)
-
-            # since the inner PCMReaderWindow only outputs part
-            # of the accuraterip reader, we need to ensure
-            # anything left over in accuraterip gets processed also
-            audiotools.transfer_data(accuraterip.read, lambda f: None)
-        except audiotools.EncodingError as err:
-            self.update_state(state='FAILURE', meta={'error': str(err)})
-            raise Ignore()
-
-        track.set_metadata(output_metadata)
-
-        rip_log[track_number] = cddareader.log()
-        accuraterip_log_v1[track_number] = accuraterip.checksums_v1()
-        accuraterip_log_v2[track_number] = accuraterip.checksums_v2()
+            # only the workers that rip pay for importing audiotools and the rest
+            import ripping
+            return ripping.rip(self, drives.device(claimed), slot)
+        finally:
+            if slot is not None:
+                drives.unload(changer, slot, claimed)
+    finally:
+        heartbeat.set()
+        drives.release(claimed, self.request.id)
+        scheduler.finished(self.request.id)
+        scheduler.dispatch(send_rip)
+
+
+def send_rip(job):
+    """Sends off a job the scheduler has picked for a drive"""
+    rip_disk.apply_async(kwargs={'slot': job['slot'], 'drive': job['drive']}, task_id=job['id'])
+
+
+@celery.task(bind=True, max_retries=None)
+def prewarm_metadata(self, slots=None):
+    """Loads each full slot in slots (or the whole magazine) just long enough to read its TOC,
+    so its metadata and AccurateRip data are cached before it's ripped, the slot table can show
+    it and the scheduler knows how long it'll take"""
+    claimed = drives.claim(self.request.id)
+    if claimed is None:
+        raise self.retry(countdown=config.option(app, 'ripper', 'drive_retry', 10, int))
+    changer = get_changer()
+    mirror = make_mirror(app)
+    lookups = ThreadPoolExecutor(max_workers=4)
+    heartbeat = drives.hold(claimed, self.request.id)
+    try:
+        with drives.changer_lock():
+            status = changer.update_status()
+        to_read = [slot for slot in sorted(status, key=int)
+                   if status[slot]['full'] and (slots is None or int(slot) in slots) and
+                   (metadata_cache.slot_key(slot) is None or scheduler.frames(slot) is None)]
+        for index, slot in enumerate(to_read):
+            self.update_state(state='PROGRESS', meta={'current': index,
+                                                      'total': len(to_read),
+                                                      'slot': slot,
+                                                      'status': 'Reading TOC'})
+            drives.load(changer, slot, claimed)
+            try:
+                cddareader = open_cddareader(drives.device(claimed))
+                disc_key = discid.toc_key(cddareader)
+            except (IOError, ValueError, OSError):
+                continue
+            finally:
+                drives.unload(changer, slot, claimed)
+            # the lookups only need the TOC, so the next disc can be loaded meanwhile
+            lookups.submit(metadata_cache.lookup, disc_key, cddareader)
+            lookups.submit(mirror.lookup, discid.accuraterip_ids(cddareader))
+            metadata_cache.set_slot(slot, disc_key)
+            scheduler.remember_frames(slot, discid.total_frames(cddareader))
+    finally:
+        lookups.shutdown(wait=True)
+        heartbeat.set()
+        drives.release(claimed, self.request.id)
+        scheduler.dispatch(send_rip)
+    return {'status': 'done', 'slots': to_read}
 
-    self.update_state(state='SUCCESS', meta={'total': len(tracks_to_rip),
-                                             'album': album,
-                                             'artist': artist,
-                                             'metadata': jsonify_metadata(metadata_choices[0]),
-                                             'status': 'Fully ripped'})
 
-    return {'status': 'done', 'tracks': len(tracks_to_rip)}
+@celery.task(bind=True)
+def batch_rip(self, slots=None, priority=0):
+    """Loads, rips and returns every full slot in slots (or the whole magazine) unattended.
+
+    The slots are queued with the scheduler at priority, so the quickest discs go first and as
+    soon as a drive is done with a disc the next one is loaded into it while the other drives
+    keep ripping. Slots that have been prewarmed are the ones it can estimate properly."""
+    changer = get_changer()
+    with drives.changer_lock():
+        status = changer.update_status()
+    estimator = make_estimator(app, make_rip_log(app))
+    # among discs expected to take as long as each other, working outwards from the drives
+    # keeps each trip to a drive and back short
+    planner = make_planner(app, changer.ioslot)
+    nearest_drive = min(planner.drive_positions)
+    waiting = {slot: scheduler.add(slot, priority, estimator)
+               for slot in sorted(status, key=lambda slot: (abs(int(slot) - nearest_drive),
+                                                            int(slot)))
+               if status[slot]['full'] and (slots is None or int(slot) in slots)}
+    scheduler.dispatch(send_rip)
+    done = []
+    failed = []
+    frames = 0
+    started = time.time()
+    poll = config.option(app, 'ripper', 'batch_poll', 5, float)
+
+    while waiting:
+        for slot, job_id in list(waiting.items()):
+            result = rip_disk.AsyncResult(job_id)
+            if result.ready():
+                del waiting[slot]
+                if result.successful():
+                    done.append(slot)
+                    frames += result.result.get('frames', 0)
+                else:
+                    failed.append(slot)
+
+        pending = [slot for slot, job_id in waiting.items() if scheduler.queued(job_id)]
+        elapsed = time.time() - started
+        self.update_state(state='PROGRESS', meta={
+            'pending': sorted(pending, key=int),
+            'running': {slot: job_id for slot, job_id in waiting.items() if slot not in pending},
+            'done': done,
+            'failed': failed,
+            'elapsed': elapsed,
+            'eta': scheduler.etas()['eta'],
+            'discs_per_hour': len(done) * 3600 / elapsed if elapsed > 0 else 0,
+            'mb_per_second': frames * 4 / 1000000 / elapsed if elapsed > 0 else 0,
+            'status': 'Ripping'})
+        if waiting:
+            time.sleep(poll)
+
+    elapsed = time.time() - started
+    return {'status': 'done',
+            'done': done,
+            'failed': failed,
+            'elapsed': elapsed,
+            'discs_per_hour': len(done) * 3600 / elapsed if elapsed > 0 else 0,
+            'mb_per_second': frames * 4 / 1000000 / elapsed if elapsed > 0 else 0}
 
 
 @celery.task(bind=True)
 def mtx_command(self, command, **kwargs):
+    changer = get_changer()
     metadata = {
         "command": command,
         "kwargs": kwargs,
         "status": changer.get_status()
     }
     self.update_state(state='PROGRESS', meta=metadata)
+    if command == "plan":
+        # moves is a list of {"command": ..., "slot": ..., "drive": ...} to do in the best order
+        planner = make_planner(app, changer.ioslot)
+        metadata['moves'] = planner.plan(kwargs['moves'], changer.get_status())
+        metadata['done'] = []
+        self.update_state(state='PROGRESS', meta=metadata)
+        for move in metadata['moves']:
+            with drives.changer_lock():
+                changer.execute(move)
+            metadata['done'].append(move)
+            self.update_state(state='PROGRESS', meta=metadata)
     if command == "update_status" or metadata['status'] == {}:
         metadata['status'] = changer.update_status()
         self.update_state(state='PROGRESS', meta=metadata)
@@ -293,7 +234,8 @@ def mtx_command(self, command, **kwargs):
             slot = kwargs['slot']
         metadata["slot"] = slot
         self.update_state(state='PROGRESS', meta=metadata)
-        result = changer.load(slot)
+        with drives.changer_lock():
+            result = changer.load(slot)
         if result:
             metadata['loaded'] = True
             metadata['slot'] = result
@@ -302,7 +244,11 @@ def mtx_command(self, command, **kwargs):
     if command == "eject":
         metadata["slot"] = kwargs['slot']
         self.update_state(state='PROGRESS', meta=metadata)
-        metadata['ejected'] = changer.eject(kwargs['slot'])
+        with drives.changer_lock():
+            metadata['ejected'] = changer.eject(kwargs['slot'])
+        if metadata['ejected']:
+            metadata_cache.forget_slot(kwargs['slot'])
+            scheduler.forget_frames(kwargs['slot'])
     if command == "load_drive":
         drive = 0
         if "drive" in kwargs:
@@ -310,17 +256,17 @@ def mtx_command(self, command, **kwargs):
         metadata['slot'] = kwargs['slot']
         metadata['drive'] = drive
         self.update_state(state='PROGRESS', meta=metadata)
-        changer.load_drive(kwargs['slot'], drive)
+        drives.load(changer, kwargs['slot'], drive)
     if command == "unload_drive":
-        # drive = 0
-        # if "drive" in kwargs:
-        #     drive = kwargs["drive"]
-        # metadata['drive'] = drive
+        drive = 0
+        if "drive" in kwargs:
+            drive = kwargs["drive"]
+        metadata['drive'] = drive
         slot = None
         if "slot" in kwargs:
             slot = kwargs["slot"]
         metadata['slot'] = slot
         self.update_state(state='PROGRESS', meta=metadata)
-        changer.unload_drive(slot)
-    metadata['status'] = changer.get_status()
+        drives.unload(changer, slot, drive)
+    metadata['status'] = metadata_cache.annotate(changer.get_status())
     return metadata
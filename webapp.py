@@ -1,38 +1,101 @@
 #!/usr/bin/env python3
-from flask import Flask, render_template, jsonify, url_for
-import tasks
+from flask import Flask, render_template, jsonify, url_for, request, Response
 import config
+import json
+import time
+from celerymaker import task_channel
+from progress import load_disc
+from inventory import Inventory
+from metrics import Metrics, labels
+from redismaker import make_redis
+from signatures import TaskSignatures
+from drives import make_drive_pool
+from metacache import make_metadata_cache
+from riplog import make_rip_log
+from scheduler import Scheduler, make_estimator
 from sh import git
 
 app = Flask(__name__)
 config.configure(app)
+redis = make_redis(app)
+inventory = Inventory(redis)
+metrics = Metrics(redis)
+# the webapp only ever queues tasks by name, so it never has to import tasks
+tasks = TaskSignatures(app)
+drives = make_drive_pool(app, redis)
+scheduler = Scheduler(redis, drives)
+metadata_cache = make_metadata_cache(app)
+rip_log = make_rip_log(app)
+
+
+def send_rip(job):
+    """Sends off a job the scheduler has picked for a drive"""
+    tasks.rip_disk.apply_async(kwargs={'slot': job['slot'], 'drive': job['drive']},
+                               task_id=job['id'])
 
 
 @app.route('/ripdisk')
 def rip_disk():
-    """Initializes the ripping of a disk"""
-    task = tasks.rip_disk.apply_async()
+    """Initializes the ripping of a disk, optionally loading it from ?slot= into ?drive= first.
+
+    Without a drive, a slot is queued with the scheduler at ?priority= (higher goes first) to be
+    ripped by whichever drive frees up"""
+    slot = request.args.get('slot')
+    drive = request.args.get('drive', type=int)
+    if drive is not None and not 0 <= drive < len(drives.devices):
+        return "There's no drive %d" % drive, 400
+    if drive is None and slot is not None:
+        task_id = scheduler.add(slot, request.args.get('priority', 0, type=int),
+                                make_estimator(app, rip_log))
+        scheduler.dispatch(send_rip)
+        url = url_for('ripstatus', task_id=task_id)
+        return "<a href=\"%s\">%s</a> (<a href=\"%s\">eta</a>)" % (
+            url, url, url_for('schedule_job', job_id=task_id))
+    if drive is None:
+        # without a slot to load from, the disc has to already be in the first drive
+        drive = 0
+    drives.enqueue(drive)
+    task = tasks.rip_disk.apply_async(kwargs={'slot': slot, 'drive': drive})
     url = url_for('ripstatus', task_id=task.id)
     return "<a href=\"%s\">%s</a>" % (url, url)
 
 
+@app.route('/schedule')
+def schedule():
+    """Shows the running and queued rips in the order they'll go, with when each should be
+    done and when the whole queue should be"""
+    return jsonify(scheduler.etas())
+
+
+@app.route('/schedule/<job_id>')
+def schedule_job(job_id):
+    """Shows when a single queued or running rip should start and be done"""
+    job = scheduler.eta(job_id)
+    if job is None:
+        return jsonify({'error': 'not queued or running',
+                        'status': url_for('ripstatus', task_id=job_id)}), 404
+    return jsonify(job)
+
+
 @app.route('/rip/status/<task_id>')
 def ripstatus(task_id):
     """Shows info about the status of an on-going disk ripping"""
     task = tasks.rip_disk.AsyncResult(task_id)
-    if task.state == 'PENDING':
+    if task.state in ('PENDING', 'RETRY'):
+        # a retrying rip is still waiting for a drive, and has no info to show
         response = {
             'state': task.state,
             'current': 0,
             'total': 1,
-            'status': 'Pending...'
+            'status': 'Pending...' if task.state == 'PENDING' else 'Waiting for a drive...'
         }
     elif task.state != 'FAILURE':
         response = {
             'state': task.state,
-            'info': task.info
+            'info': task.info,
+            'disc': load_disc(redis, task_id)
         }
-        if 'result' in task.info:
+        if isinstance(task.info, dict) and 'result' in task.info:
             response['result'] = task.info['result']
     else:
         # something went wrong in the background job
@@ -45,6 +108,147 @@ def ripstatus(task_id):
     return jsonify(response)
 
 
+def parse_slots(text):
+    """Turns a slot list like "1-20,25,30-40" into a list of slot numbers"""
+    slots = []
+    for part in text.split(","):
+        if "-" in part:
+            first, last = part.split("-", 1)
+            slots.extend(range(int(first), int(last) + 1))
+        elif part.strip() != "":
+            slots.append(int(part))
+    return slots
+
+
+@app.route('/batch/rip')
+def batch_rip():
+    """Rips every full slot in ?slots= (or the whole magazine) unattended, at ?priority="""
+    slots = request.args.get('slots')
+    if slots is not None:
+        try:
+            slots = parse_slots(slots)
+        except ValueError:
+            return jsonify({'error': 'slots should look like 1-20,25'}), 400
+    priority = request.args.get('priority', 0, type=int)
+    task = tasks.batch_rip.apply_async(kwargs={'slots': slots, 'priority': priority})
+    return jsonify({'updates': url_for('batch_status', task_id=task.id),
+                    'events': url_for('task_events', task_id=task.id)})
+
+
+@app.route('/changer/prewarm')
+def init_changer_prewarm():
+    """Reads the TOC of every full slot in ?slots= (or the whole magazine) to cache its metadata"""
+    slots = request.args.get('slots')
+    if slots is not None:
+        try:
+            slots = parse_slots(slots)
+        except ValueError:
+            return jsonify({'error': 'slots should look like 1-20,25'}), 400
+    task = tasks.prewarm_metadata.apply_async(kwargs={'slots': slots})
+    return jsonify({'updates': url_for('changer_updates', task_id=task.id),
+                    'events': url_for('task_events', task_id=task.id)})
+
+
+@app.route('/batch/status/<task_id>')
+def batch_status(task_id):
+    """Shows the progress and aggregate throughput of a batch rip"""
+    task = tasks.batch_rip.AsyncResult(task_id)
+    response = {'task_id': task_id, 'state': task.state}
+    if task.state == 'SUCCESS':
+        response['info'] = task.result
+    elif task.state != 'FAILURE':
+        response['info'] = task.info
+    else:
+        response['status'] = str(task.info)
+    return jsonify(response)
+
+
+@app.route('/drives/status')
+def drive_status():
+    """Shows what each drive is doing and how many jobs are queued for it"""
+    return jsonify({'drives': drives.status()})
+
+
+@app.route('/metrics')
+def prometheus_metrics():
+    """Exposes the ripping metrics, plus what the drives are doing right now, for Prometheus"""
+    status = drives.status()
+    gauges = [('ripper_drive_busy', "Whether a drive is claimed by a job",
+               {labels(device=drive['device']): 1 if drive['busy'] else 0 for drive in status}),
+              ('ripper_drive_queued', "Jobs waiting for a drive",
+               {labels(device=drive['device']): drive['queued'] for drive in status})]
+    return Response(metrics.render(gauges), mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/riplog/drives')
+def riplog_drives():
+    """Error rates for each drive, over every rip since ?since= (a unix time)"""
+    return jsonify({'drives': rip_log.drives(request.args.get('since', 0, type=float))})
+
+
+@app.route('/riplog/speeds')
+def riplog_speeds():
+    """How fast the drives really read at each speed setting, since ?since="""
+    return jsonify({'speeds': rip_log.speeds(request.args.get('since', 0, type=float))})
+
+
+@app.route('/riplog/rerips')
+def riplog_rerips():
+    """Discs whose latest rip since ?since= has tracks that should be ripped again"""
+    return jsonify({'discs': rip_log.rerips(request.args.get('since', 0, type=float))})
+
+
+# states a task never leaves, so there's nothing more to stream
+FINISHED_STATES = ('SUCCESS', 'FAILURE', 'REVOKED', 'IGNORED')
+
+
+def task_update(task_id):
+    """Describes the current state of a task the same way its published updates do"""
+    task = tasks.celery.AsyncResult(task_id)
+    response = {'task_id': task_id, 'state': task.state, 'disc': load_disc(redis, task_id)}
+    if task.state == 'FAILURE':
+        response['info'] = str(task.info)
+    else:
+        response['info'] = task.info
+    return response
+
+
+@app.route('/events/<task_id>')
+def task_events(task_id):
+    """Streams updates about a task to the browser as server-sent events, checking on the task
+    every ripper.events_keepalive seconds in case it stopped without saying so"""
+    keepalive = config.option(app, 'ripper', 'events_keepalive', 15, float)
+
+    def stream():
+        pubsub = redis.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(task_channel(task_id))
+        try:
+            # anything from before we subscribed is covered by the current state
+            update = task_update(task_id)
+            yield "data: %s\n\n" % json.dumps(update, default=str)
+            if update['state'] in FINISHED_STATES:
+                return
+            checked = time.time()
+            while True:
+                message = pubsub.get_message(timeout=1.0)
+                if message is not None:
+                    yield "data: %s\n\n" % message['data']
+                    if json.loads(message['data'])['state'] in FINISHED_STATES:
+                        return
+                if time.time() - checked >= keepalive:
+                    # a task that was lost or ignored never says it's done, and a browser that
+                    # went away is only noticed when something's written to it
+                    checked = time.time()
+                    update = task_update(task_id)
+                    if update['state'] in FINISHED_STATES:
+                        yield "data: %s\n\n" % json.dumps(update, default=str)
+                        return
+                    yield ": keepalive\n\n"
+        finally:
+            pubsub.close()
+    return Response(stream(), mimetype='text/event-stream')
+
+
 @app.route("/")
 def hello():
     """Displays the main page"""
@@ -53,9 +257,17 @@ def hello():
 
 @app.route("/changer/status")
 def init_changer_status():
-    """Checks the status of the changer"""
-    task = tasks.mtx_command.apply_async(["get_status"])
-    return jsonify({'updates': url_for('changer_updates', task_id=task.id)})
+    """Checks the status of the changer, straight from the inventory unless ?rescan= is given"""
+    status, ioslot = inventory.load()
+    if status and 'rescan' not in request.args:
+        return jsonify({'state': 'SUCCESS',
+                        'info': {'command': 'get_status',
+                                 'status': metadata_cache.annotate(status),
+                                 'scanned': inventory.scanned()}})
+    task = tasks.mtx_command.apply_async(["update_status" if 'rescan' in request.args
+                                          else "get_status"])
+    return jsonify({'updates': url_for('changer_updates', task_id=task.id),
+                    'events': url_for('task_events', task_id=task.id)})
 
 
 @app.route("/changer/updates/<task_id>")
@@ -72,13 +284,23 @@ def changer_updates(task_id):
 def init_changer_eject(slot):
     """Ejects a disc from the changer"""
     task = tasks.mtx_command.apply_async(["eject"], {"slot": slot})
-    return jsonify({'updates': url_for('changer_updates', task_id=task.id)})
+    return jsonify({'updates': url_for('changer_updates', task_id=task.id),
+                    'events': url_for('task_events', task_id=task.id)})
 
 
 @app.route("/changer/load/<slot>",  defaults={'slot': None})
 def init_changer_load(slot):
     task = tasks.mtx_command.apply_async(["load"], {"slot": slot})
-    return jsonify({'updates': url_for('changer_updates', task_id=task.id)})
+    return jsonify({'updates': url_for('changer_updates', task_id=task.id),
+                    'events': url_for('task_events', task_id=task.id)})
+
+
+@app.route("/changer/plan", methods=["POST"])
+def init_changer_plan():
+    """Carries out a batch of moves, posted as a JSON list, in whatever order is quickest"""
+    task = tasks.mtx_command.apply_async(["plan"], {"moves": request.get_json()})
+    return jsonify({'updates': url_for('changer_updates', task_id=task.id),
+                    'events': url_for('task_events', task_id=task.id)})
 
 
 @app.route('/githook', methods=["POST"])
@@ -87,4 +309,4 @@ def githook():
     return "kthx"
 
 if __name__ == "__main__":
-    app.run(debug=True, host='0.0.0.0')
+    app.run(debug=True, host='0.0.0.0', threaded=True)